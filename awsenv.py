@@ -1,14 +1,32 @@
 import argparse
-from datetime import datetime, timezone
+import collections
+import concurrent.futures
+import contextlib
+import copy
+from datetime import datetime, timedelta, timezone
+import fcntl
+import functools
+import hashlib
+import hmac
 import json
+import math
 import os
 import pyotp
+import random
+import re
 import shlex
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ElementTree
 
 OURNAME = "devenv-awsenv"
 
@@ -28,12 +46,337 @@ REQUIRED = set([
     "AWS_SECRET_ACCESS_KEY",
 ])
 
+# Substrings of awscli error output for each class of STS failure
+STS_ERRORS = (
+    ("throttled", (
+        "Throttling",
+        "Rate exceeded",
+        "TooManyRequests",
+        "RequestLimitExceeded",
+    )),
+    ("clock-skew", (
+        "RequestTimeTooSkewed",
+        "Signature expired",
+    )),
+    ("bad-code", (
+        "MultiFactorAuthentication failed",
+        "one time pass code",
+    )),
+    ("network", (
+        "Could not connect to the endpoint URL",
+        "Connect timeout",
+        "Read timeout",
+        "Connection was closed",
+    )),
+)
+
+RETRYABLE_STS_ERRORS = set(["throttled", "network"])
+
+STS_MAX_RETRIES = 5
+STS_BACKOFF_BASE = 1.0 # seconds
+STS_BACKOFF_CAP = 30.0 # seconds
+
+STS_NAMESPACE = "{https://sts.amazonaws.com/doc/2011-06-15/}"
+
+# Cached "awsenv whoami" results for credentials without an MFA session are
+# rechecked after this many seconds
+WHOAMI_TTL = 3600
+
+# OTP-backed sessions are refreshed up to this many seconds early, by a random
+# amount, so that a team's sessions don't all hit STS at the same moment
+EARLY_REFRESH = 300
+
+# Sessions are reported as "expiring" this many seconds before they expire
+WARN_BEFORE = 600
+
+# "awsenv watch" rereads sessions at least this often even when no session
+# is about to expire, to notice sessions created by other processes
+WATCH_MAX_SLEEP = 900
+
+# Commands whose timing and outcome are written to the event log
+LOGGED_COMMANDS = set(["auth", "edit", "export"])
+
+EVENT_LOG_MAX_BYTES = 1024 * 1024
+EVENT_LOG_KEEP = 3 # rotated files kept in addition to the current one
+
+# Keyring backends aren't documented as thread safe; "export-many"
+# authenticates several envs from threads
+KEYRING_LOCK = threading.Lock()
+
+def get_state_dir():
+    state_dir = os.environ.get("DEVENV_AWSENV_STATE_DIR")
+    if state_dir:
+        return state_dir
+    state_home = os.environ.get("XDG_STATE_HOME")
+    if not state_home:
+        state_home = os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(state_home, OURNAME)
+
+@functools.lru_cache(maxsize=64)
+def parse_expiry(exprstr):
+    """ AWS_SESSION_EXPIRES as an aware datetime, or None if unparseable """
+    if not exprstr:
+        return None
+    try:
+        exprdt = datetime.fromisoformat(exprstr)
+    except (ValueError, TypeError):
+        return None
+    if exprdt.tzinfo is None:
+        exprdt = exprdt.replace(tzinfo=timezone.utc)
+    return exprdt
+
+def acquire_watch_lock(state_dir):
+    """ Open and lock ``watch.lock`` in the state dir without blocking;
+    returns the open lock file, or None if another watcher holds it """
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    lock = open(os.path.join(state_dir, "watch.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def percentile(values, pct):
+    # nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class EventLog:
+    """ Append-only JSON Lines log of awsenv command timings and outcomes """
+    def __init__(self, state_dir):
+        self.path = os.path.join(state_dir, "events.jsonl")
+
+    def rotated(self, n):
+        return f"{self.path}.{n}"
+
+    def rotate(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < EVENT_LOG_MAX_BYTES:
+            return
+        for n in range(EVENT_LOG_KEEP - 1, 0, -1):
+            if os.path.exists(self.rotated(n)):
+                os.replace(self.rotated(n), self.rotated(n + 1))
+        os.replace(self.path, self.rotated(1))
+
+    def append(self, event):
+        # the event log must never break the command being logged
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            self.rotate()
+            with open(self.path, "a") as f:
+                f.write(json.dumps(event, sort_keys=True) + "\n")
+        except OSError:
+            pass
+
+    def load(self):
+        events = []
+        paths = [ self.rotated(n) for n in range(EVENT_LOG_KEEP, 0, -1) ]
+        paths.append(self.path)
+        for path in paths:
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                try:
+                    events.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    continue
+        return events
+
+    def stats(self, out):
+        events = self.load()
+        if not events:
+            out(f"No events recorded in {self.path}")
+            return 1
+
+        def summarize(label, group):
+            durations = [ e.get("duration", 0) for e in group ]
+            failures = [ e for e in group if e.get("outcome") != "ok" ]
+            failpct = 100 * len(failures) / len(group)
+            out(
+                f"{label:<32} {len(group):>6} "
+                f"{percentile(durations, 50):>7.3f}s "
+                f"{percentile(durations, 95):>7.3f}s "
+                f"{failpct:>6.1f}%"
+            )
+
+        def header(label):
+            out(
+                f"{label:<32} {'count':>6} {'p50':>8} {'p95':>8} "
+                f"{'failed':>7}"
+            )
+
+        by_command = collections.defaultdict(list)
+        by_machine = collections.defaultdict(list)
+        sessions = collections.Counter()
+        for event in events:
+            by_command[event.get("command")].append(event)
+            machine = f"{event.get('host')} ({event.get('backend')})"
+            by_machine[machine].append(event)
+            if event.get("authenticated"):
+                sessions[event.get("env")] += 1
+
+        header("command")
+        for command, group in sorted(by_command.items()):
+            summarize(command, group)
+
+        out("")
+        header("host (keyring backend)")
+        for machine, group in sorted(by_machine.items()):
+            summarize(machine, group)
+
+        keyring_calls = [ e.get("keyring_calls", 0) for e in events ]
+        subprocess_time = [ e.get("subprocess_time", 0) for e in events ]
+        out("")
+        out(f"keyring calls per command (p50/p95): "
+            f"{percentile(keyring_calls, 50)}/{percentile(keyring_calls, 95)}")
+        out(f"subprocess time per command (p50/p95): "
+            f"{percentile(subprocess_time, 50):.3f}s/"
+            f"{percentile(subprocess_time, 95):.3f}s")
+
+        out("")
+        out("MFA sessions per env")
+        if not sessions:
+            out("  (none)")
+        for env, count in sorted(sessions.items()):
+            out(f"  {env:<30} {count:>6}")
+
+def quote_fish(value):
+    escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+def quote_dotenv(value):
+    if "'" not in value and "\n" not in value:
+        return f"'{value}'"
+    return json.dumps(value, ensure_ascii=False)
+
+def quote_nu(value):
+    # nu's double-quoted strings take JSON's escapes except for "\uXXXX",
+    # which nu spells "\u{XXXX}"; only control characters get one here
+    return re.sub(
+        r"\\(u([0-9a-f]{4})|.)",
+        lambda m: f"\\u{{{m.group(2)}}}" if m.group(2) else m.group(0),
+        json.dumps(value, ensure_ascii=False),
+    )
+
+def export_sh(envvars, watch):
+    lines = []
+    for k, v in sorted(envvars.items()):
+        lines.append(f"{k}={shlex.quote(v)}")
+        lines.append(f"export {k}")
+    return lines
+
+def export_direnv(envvars, watch):
+    # direnv reruns .envrc when any watched file's mtime changes
+    lines = [ f"watch_file {shlex.quote(path)}" for path in watch ]
+    return lines + export_sh(envvars, watch)
+
+def export_fish(envvars, watch):
+    return [
+        f"set -gx {k} {quote_fish(v)}" for k, v in sorted(envvars.items())
+    ]
+
+def export_nu(envvars, watch):
+    return [
+        f"$env.{k} = {quote_nu(v)}" for k, v in sorted(envvars.items())
+    ]
+
+def export_dotenv(envvars, watch):
+    return [
+        f"{k}={quote_dotenv(v)}" for k, v in sorted(envvars.items())
+    ]
+
+def export_json(envvars, watch):
+    return [ json.dumps(envvars, indent=4, sort_keys=True) ]
+
+EXPORT_FORMATS = {
+    "direnv": export_direnv,
+    "dotenv": export_dotenv,
+    "fish": export_fish,
+    "json": export_json,
+    "nu": export_nu,
+    "sh": export_sh,
+}
+
+def sha256hex(data):
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def hmac_sha256(key, data):
+    return hmac.new(key, data.encode("utf-8"), hashlib.sha256).digest()
+
+def caller_identity_request(creds, region, endpoint, now):
+    """ A SigV4-signed STS GetCallerIdentity request as (url, headers, body)
+    """
+    host = urllib.parse.urlsplit(endpoint).netloc
+    body = "Action=GetCallerIdentity&Version=2011-06-15"
+    amzdate = now.strftime("%Y%m%dT%H%M%SZ")
+    datestamp = now.strftime("%Y%m%d")
+    headers = {
+        "content-type": "application/x-www-form-urlencoded; charset=utf-8",
+        "host": host,
+        "x-amz-date": amzdate,
+    }
+    token = creds.get("AWS_SESSION_TOKEN")
+    if token:
+        headers["x-amz-security-token"] = token
+    signed_headers = ";".join(sorted(headers))
+    canonical_request = "\n".join([
+        "POST",
+        "/",
+        "",
+        "".join(f"{k}:{headers[k]}\n" for k in sorted(headers)),
+        signed_headers,
+        sha256hex(body),
+    ])
+    scope = f"{datestamp}/{region}/sts/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256",
+        amzdate,
+        scope,
+        sha256hex(canonical_request),
+    ])
+    key = ("AWS4" + creds["AWS_SECRET_ACCESS_KEY"]).encode("utf-8")
+    for part in (datestamp, region, "sts", "aws4_request"):
+        key = hmac_sha256(key, part)
+    signature = hmac.new(
+        key, string_to_sign.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    headers["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={creds['AWS_ACCESS_KEY_ID']}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return endpoint, headers, body
+
 class Config:
     def __init__(self, env, keyring):
         if env is None:
             env = "dev"
         self.current_env = env
         self.keyring = keyring
+        # per-process counters for the event log
+        self.keyring_calls = 0
+        self.subprocess_time = 0.0
+        self.authenticated = False
+        self.state_dir = get_state_dir()
+        # "awsenv watch --refresh" early refresh offset, per env
+        self.refresh_jitter = {}
+        # Optional Linux kernel keyring (e.g. "@u" or "@s") used as a
+        # memory-only cache for short-lived derived session credentials
+        self.kernel_keyring = os.environ.get("DEVENV_AWSENV_KERNEL_KEYRING")
+        self.keyctl = os.environ.get("DEVENV_AWSENV_KEYCTL", "keyctl")
+        self.early_refresh = int(
+            os.environ.get("DEVENV_AWSENV_EARLY_REFRESH", EARLY_REFRESH)
+        )
+        self.warn_before = int(
+            os.environ.get("DEVENV_AWSENV_WARN_BEFORE", WARN_BEFORE)
+        )
         self.initialize_missing(self.current_env)
         self.envdata = self.load(self.current_env)
         derived = self.load_derived(self.current_env)
@@ -43,13 +386,55 @@ class Config:
         self.derived = derived
 
     def get_password(self, key, default=None):
+        self.keyring_calls += 1
         try:
-            return self.keyring.get_password(OURNAME, key)
+            with KEYRING_LOCK:
+                return self.keyring.get_password(OURNAME, key)
         except self.keyring.errors.InitError:
             return default
 
     def set_password(self, env, serialized):
-        self.keyring.set_password(OURNAME, env, serialized)
+        self.keyring_calls += 1
+        with KEYRING_LOCK:
+            self.keyring.set_password(OURNAME, env, serialized)
+
+    def delete_password(self, key):
+        self.keyring_calls += 1
+        with KEYRING_LOCK:
+            self.keyring.delete_password(OURNAME, key)
+
+    def cache_get(self, key):
+        if not self.kernel_keyring:
+            return None
+        result = self.run_keyctl(["pipe", f"%user:{OURNAME}:{key}"])
+        if result is None or result.returncode != 0:
+            return None
+        return result.stdout
+
+    def cache_set(self, key, serialized, timeout):
+        if not self.kernel_keyring:
+            return
+        result = self.run_keyctl(
+            ["padd", "user", f"{OURNAME}:{key}", self.kernel_keyring],
+            input=serialized,
+        )
+        if result is None or result.returncode != 0:
+            return
+        keyid = result.stdout.strip()
+        self.run_keyctl(["timeout", keyid, str(math.ceil(timeout))])
+
+    def cache_delete(self, key):
+        if not self.kernel_keyring:
+            return
+        self.run_keyctl(["invalidate", f"%user:{OURNAME}:{key}"])
+
+    def run_keyctl(self, args, **kw):
+        try:
+            return self.run([self.keyctl] + args, **kw)
+        except OSError:
+            # keyctl is not available; don't try again in this process
+            self.kernel_keyring = None
+            return None
 
     def get_changed(self, old, new):
         changed = set({ k: v for k, v in new.items() if old.get(k) != v })
@@ -83,8 +468,12 @@ class Config:
 
         old_deserialized = json.loads(old)
 
+        # mkstemp creates the file mode 0600
         with tempfile.NamedTemporaryFile(
-                suffix=".json", mode="w+", delete=False) as tf:
+                suffix=".json",
+                mode="w+",
+                delete=False,
+                dir=self.edit_tempdir()) as tf:
             temp_filename = tf.name
             tf.write(old)
             tf.flush()
@@ -95,34 +484,80 @@ class Config:
             self.call(cmd)
             with open(temp_filename) as f:
                 new = f.read()
-                try:
-                    new_deserialized = json.loads(new)
-                except Exception:
-                    self.save(env, new)
-                    exc = traceback.format_exc()
-                    self.errout(exc)
-                    self.errout("Could not deserialize new data, re-edit")
-                    return 1
-                else:
-                    missing = self.get_missing(new_deserialized)
-                    if missing:
-                        self.save(env, new)
-                        self.errout(
-                            f"missing required keys: {missing}, re-edit"
-                        )
-                        return 1
-                    self.save(env, new)
-                    derived = self.derived_after_changes(
-                        env,
-                        old_deserialized,
-                        new_deserialized,
-                    )
-                    self.save_derived(env, derived)
-                    if old_deserialized != new_deserialized:
-                        self.show_activate_changes_tip()
         finally:
             os.unlink(temp_filename)
 
+        try:
+            new_deserialized = json.loads(new)
+        except Exception:
+            self.save(env, new)
+            exc = traceback.format_exc()
+            self.errout(exc)
+            self.errout("Could not deserialize new data, re-edit")
+            return 1
+        missing = self.get_missing(new_deserialized)
+        if missing:
+            self.save(env, new)
+            self.errout(f"missing required keys: {missing}, re-edit")
+            return 1
+        self.save(env, new)
+        derived = self.derived_after_changes(
+            env,
+            old_deserialized,
+            new_deserialized,
+        )
+        self.save_derived(env, derived)
+        if old_deserialized != new_deserialized:
+            self.show_activate_changes_tip()
+
+    def edit_tempdir(self):
+        # prefer a memory-backed filesystem so the edit buffer, which holds
+        # secrets, never reaches the disk
+        for candidate in (os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"):
+            if (
+                    candidate and
+                    os.path.isdir(candidate) and
+                    os.access(candidate, os.W_OK)
+            ):
+                return candidate
+        return None
+
+    def set_keys(self, assignments, envs=None):
+        changes = {}
+        for assignment in assignments:
+            key, sep, value = assignment.partition("=")
+            if not (key and sep):
+                self.errout(f"Expected KEY=VALUE, got {assignment}")
+                return 1
+            changes[key] = value
+        if not envs:
+            envs = [self.current_env]
+        others = [ env for env in envs if env != self.current_env ]
+        known = self.load_meta()["envs"] if others else []
+        # check every env before writing any, so a typo leaves none changed
+        olds = {self.current_env: self.envdata}
+        for env in others:
+            old = self.load(env) if env in known else None
+            if old is None:
+                self.errout(f"No such env {env}")
+                return 1
+            olds[env] = old
+        for env in envs:
+            old = olds[env]
+            new = dict(old)
+            new.update(changes)
+            changed = self.get_changed(old, new)
+            if not changed:
+                continue
+            self.save(env, self.serialize(new))
+            if changed & CHANGES_DERIVED:
+                self.save_derived(env, '{}')
+            if env == self.current_env:
+                self.envdata = new
+                if changed & CHANGES_DERIVED:
+                    self.derived = {}
+                self.show_activate_changes_tip()
+
     def show_activate_changes_tip(self):
         self.errout(
             "To activate your changes, run:\n\n"
@@ -132,33 +567,70 @@ class Config:
 
     def save(self, env, serialized):
         self.set_password(env, serialized)
+        self.touch_stamp(env)
 
     def save_derived(self, env, serialized):
         self.set_password(f"{env}-derived", serialized)
+        self.touch_stamp(env)
+        timeout = self.seconds_left(self.deserialize(serialized, {}))
+        self.write_status(env, self.session_status(timeout))
+        if timeout is not None and timeout > 0:
+            self.cache_set(f"{env}-derived", serialized, timeout)
+        else:
+            self.cache_delete(f"{env}-derived")
 
-    def load(self, env, default=None):
-        serialized = self.get_password(env, default)
+    def deserialize(self, serialized, default=None):
         try:
             return json.loads(serialized)
         except (json.decoder.JSONDecodeError, TypeError):
             return default
 
+    def load(self, env, default=None):
+        serialized = self.get_password(env, default)
+        return self.deserialize(serialized, default)
+
     def load_derived(self, env, default=None):
-        return self.load(f"{env}-derived", default)
+        key = f"{env}-derived"
+        serialized = self.cache_get(key)
+        if serialized is not None:
+            derived = self.deserialize(serialized)
+            if derived is not None:
+                return derived
+        derived = self.load(key, default)
+        if derived is None:
+            return derived
+        timeout = self.seconds_left(derived)
+        if timeout is not None and timeout > 0:
+            self.cache_set(key, self.serialize(derived), timeout)
+        return derived
+
+    @contextlib.contextmanager
+    def locked(self, name):
+        # serializes read-modify-write cycles between awsenv processes
+        try:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+            lock = open(os.path.join(self.state_dir, f"{name}.lock"), "w")
+        except OSError:
+            yield
+            return
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
 
     def initialize_missing(self, env):
-        meta_str = self.get_password("__meta__")
-        if meta_str is None:
-            meta_str = json.dumps({"envs": [self.current_env]})
-        meta = json.loads(meta_str)
-        if not env in meta["envs"]:
-            meta["envs"].append(env)
-        meta_str = json.dumps(meta, indent=4)
-        self.set_password("__meta__", meta_str)
-        env_str = self.get_password(env, None)
-        if env_str is None:
-            template = self.get_template()
-            self.save(env, template)
+        with self.locked("meta"):
+            meta_str = self.get_password("__meta__")
+            if meta_str is None:
+                meta_str = json.dumps({"envs": [self.current_env]})
+            meta = json.loads(meta_str)
+            if not env in meta["envs"]:
+                meta["envs"].append(env)
+            meta_str = json.dumps(meta, indent=4)
+            self.set_password("__meta__", meta_str)
+            env_str = self.get_password(env, None)
+            if env_str is None:
+                template = self.get_template()
+                self.save(env, template)
 
     def get_meta(self):
         meta = self.get_password("__meta__")
@@ -172,19 +644,52 @@ class Config:
         serialized = json.dumps(config, indent=4, sort_keys=True)
         return serialized
 
-    def mfaleft(self):
-        exprstr = self.derived.get("AWS_SESSION_EXPIRES")
-        if not exprstr:
-            return "-"
-        exprdt = datetime.fromisoformat(exprstr)
-        nowutc = datetime.now(timezone.utc)
-        exprdelta = exprdt - nowutc
-        delta = str(exprdelta).split(".", 1)[0].rsplit(":", 1)[0]
-        return delta
+    def session_expires(self):
+        return parse_expiry(self.derived.get("AWS_SESSION_EXPIRES"))
+
+    def seconds_left(self, derived=None):
+        """ Seconds until the MFA session in ``derived`` (default: the
+        current env's) expires, negative if it already has, or None if
+        there is no session """
+        if derived is None:
+            derived = self.derived
+        if not isinstance(derived, dict):
+            return None
+        exprdt = parse_expiry(derived.get("AWS_SESSION_EXPIRES"))
+        if exprdt is None:
+            return None
+        return (exprdt - datetime.now(timezone.utc)).total_seconds()
+
+    def expires_within(self, seconds):
+        left = self.seconds_left()
+        return left is None or left <= seconds
 
     def mfa_expired(self):
-        delta = self.mfaleft()
-        return delta.startswith("-")
+        return self.expires_within(0)
+
+    def mfaleft(self):
+        left = self.seconds_left()
+        if left is None:
+            return "-"
+        sign = "-" if left < 0 else ""
+        hours, minutes = divmod(int(abs(left)) // 60, 60)
+        days, hours = divmod(hours, 24)
+        hhmm = f"{hours}:{minutes:02}"
+        if days == 1:
+            return f"{sign}1 day, {hhmm}"
+        if days:
+            return f"{sign}{days} days, {hhmm}"
+        return f"{sign}{hhmm}"
+
+    def mfastatus(self):
+        exprdt = self.session_expires()
+        left = self.seconds_left()
+        return {
+            "env": self.current_env,
+            "expires": exprdt.isoformat() if exprdt else None,
+            "seconds_left": int(left) if left is not None else None,
+            "expired": self.mfa_expired(),
+        }
 
     def mfacode(self):
         device = self.envdata.get("DEVENV_AWSENV_MFA_DEVICE")
@@ -201,27 +706,63 @@ class Config:
                 code = self.mfacode()
         return code
 
-    def auth(self, force=False):
+    def classify_sts_error(self, stderr):
+        for kind, needles in STS_ERRORS:
+            for needle in needles:
+                if needle in (stderr or ""):
+                    return kind
+        return "unknown"
+
+    def backoff(self, attempt):
+        # exponential backoff with "full jitter"
+        ceiling = min(STS_BACKOFF_CAP, STS_BACKOFF_BASE * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def refresh_offset(self):
+        return random.uniform(0, self.early_refresh)
+
+    def auth(self, force=False, within=None):
         device = self.envdata.get("DEVENV_AWSENV_MFA_DEVICE")
         if not device:
             return 0
 
+        envdata = self.envdata
+
+        otp_authsecret = envdata.get("DEVENV_AWSENV_MFA_OTP_AUTHSECRET")
+
         expired = self.mfa_expired()
 
+        if within is not None and not expired:
+            expired = self.expires_within(within)
+
+        if otp_authsecret and not expired:
+            expired = self.expires_within(self.refresh_offset())
+
         if not (force or expired):
             return 0
 
+        with self.locked(f"auth-{self.current_env}"):
+            if not force:
+                derived = self.load_derived(self.current_env, {})
+                left = self.seconds_left(derived)
+                if derived != self.derived and left is not None and left > 0:
+                    # another process authenticated while we waited
+                    self.derived = derived
+                    return 0
+            return self.get_session_token(device)
+
+    def get_session_token(self, device):
         envdata = self.envdata
 
+        otp_authsecret = envdata.get("DEVENV_AWSENV_MFA_OTP_AUTHSECRET")
+
         account_id = envdata["AWS_ACCOUNT_ID"]
         awsenv_aws = self.which("awsenv-aws")
 
-        otp_authsecret = envdata.get("DEVENV_AWSENV_MFA_OTP_AUTHSECRET")
-
-        returncode = None
+        attempt = 0
+        code = self.mfacode()
 
-        while returncode != 0:
-            code = self.mfacode()
+        while True:
             cmd = [
                 awsenv_aws,
                 "sts",
@@ -232,11 +773,34 @@ class Config:
                 code
             ]
             result = self.run(cmd, env=envdata)
-            if result.stderr: # pragma: no cover
+            if result.stderr:
                 self.errout(result.stderr)
-            returncode = result.returncode
-            if returncode != 0 and otp_authsecret: # pragma: no cover
+            if result.returncode == 0:
+                break
+            kind = self.classify_sts_error(result.stderr)
+            if kind in RETRYABLE_STS_ERRORS:
+                if attempt >= STS_MAX_RETRIES:
+                    self.errout(f"Giving up after {attempt} retries")
+                    return 1
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.errout(
+                    f"STS error ({kind}), retrying in {delay:.1f}s "
+                    f"({attempt}/{STS_MAX_RETRIES})"
+                )
+                self.sleep(delay)
+                if otp_authsecret:
+                    # the TOTP time step may have moved on while we slept;
+                    # a typed code is kept until STS rejects it
+                    code = self.mfacode()
+                continue
+            if kind == "clock-skew":
+                self.errout("Your system clock is skewed, fix it and retry")
+                return 1
+            if kind != "bad-code" or otp_authsecret:
                 return 1
+            # a mistyped or stale code: ask again
+            code = self.mfacode()
 
         response = json.loads(result.stdout)
         creds = response["Credentials"]
@@ -247,6 +811,7 @@ class Config:
             "AWS_SESSION_EXPIRES": creds["Expiration"],
         }
         self.derived = derived
+        self.authenticated = True
         self.save_derived(self.current_env, self.serialize(derived))
         self.errout(f"AWS MFA auth performed for {self.current_env}")
         return 0
@@ -262,6 +827,10 @@ class Config:
                 self.out(env)
 
     def delete(self, name):
+        with self.locked("meta"):
+            return self.delete_locked(name)
+
+    def delete_locked(self, name):
         meta = self.load_meta()
         envs = meta["envs"]
         current = self.current_env
@@ -274,10 +843,15 @@ class Config:
         envs.remove(name)
         meta = json.dumps(meta)
         self.set_password("__meta__", meta)
-        self.keyring.delete_password(OURNAME, name)
-        self.keyring.delete_password(OURNAME, f"{name}-derived")
+        self.delete_password(name)
+        self.delete_password(f"{name}-derived")
+        self.cache_delete(f"{name}-derived")
 
     def copy(self, src, target):
+        with self.locked("meta"):
+            return self.copy_locked(src, target)
+
+    def copy_locked(self, src, target):
         meta = self.load_meta()
         envs = meta["envs"]
         if not src in envs:
@@ -317,7 +891,96 @@ class Config:
                 self.run(cmd)
         return p
 
-    def export(self):
+    def stamp_path(self, env):
+        return os.path.join(self.state_dir, f"{env}.changed")
+
+    def touch_stamp(self, env):
+        # the stamp file's mtime changes whenever an env's data changes
+        path = self.stamp_path(env)
+        try:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except OSError:
+            pass
+
+    def status_path(self, env):
+        return os.path.join(self.state_dir, f"{env}.status")
+
+    def session_status(self, seconds_left):
+        if seconds_left is None:
+            return "none"
+        if seconds_left <= 0:
+            return "expired"
+        if seconds_left <= self.warn_before:
+            return "expiring"
+        return "ok"
+
+    def write_status(self, env, status):
+        # one word, so shells and prompts can check it without running awsenv
+        path = self.status_path(env)
+        try:
+            # leave an unchanged file alone so its mtime only moves (and
+            # direnv's watch_file only fires) when the status changes
+            with open(path) as f:
+                if f.read() == status + "\n":
+                    return
+        except OSError:
+            pass
+        try:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                f.write(status + "\n")
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass
+
+    def for_env(self, env):
+        other = copy.copy(self)
+        other.current_env = env
+        other.envdata = self.load(env, {})
+        other.derived = self.load_derived(env, {})
+        return other
+
+    def watch_once(self, refresh=False):
+        wake = WATCH_MAX_SLEEP
+        for env in self.load_meta()["envs"]:
+            derived = self.load_derived(env, {})
+            left = self.seconds_left(derived)
+            deadlines = [self.warn_before, 0]
+            if refresh:
+                # a per-env random head start, so that the watchers of a
+                # team don't all refresh the same shared env at once
+                within = self.warn_before + self.refresh_jitter.setdefault(
+                    env, self.refresh_offset()
+                )
+                deadlines.append(within)
+                if left is not None and left <= within:
+                    other = self.for_env(env)
+                    otp = other.envdata.get("DEVENV_AWSENV_MFA_OTP_AUTHSECRET")
+                    if otp and other.auth(within=within) == 0:
+                        left = self.seconds_left(other.derived)
+                        del self.refresh_jitter[env]
+            self.write_status(env, self.session_status(left))
+            if left is not None:
+                for deadline in (left - before for before in deadlines):
+                    if deadline > 0:
+                        wake = min(wake, deadline)
+        return max(1, wake)
+
+    def watch(self, refresh=False):
+        # the caller holds the watch lock (see acquire_watch_lock)
+        while True:
+            self.sleep(self.watch_once(refresh))
+
+    def watch_files(self):
+        return [
+            self.stamp_path(self.current_env),
+            self.status_path(self.current_env),
+        ]
+
+    def exported_vars(self):
         envvars = {
             "DEVENV_AWSENV": self.current_env,
         }
@@ -326,22 +989,224 @@ class Config:
         envvars.update(self.envdata)
         envvars.update(self.derived)
 
-        for k, v in sorted(envvars.items()):
-            if not k.startswith("DEVENV_AWSENV_"):
-                quoted = shlex.quote(v)
-                self.out(f"{k}={quoted}")
-                self.out(f"export {k}")
+        return {
+            k: v for k, v in envvars.items()
+            if not k.startswith("DEVENV_AWSENV_")
+        }
+
+    def export(self, format="sh"):
+        render = EXPORT_FORMATS[format]
+        self.out("\n".join(render(self.exported_vars(), self.watch_files())))
+
+    def auth_many(self, configs):
+        # OTP-backed envs don't prompt, so they can authenticate concurrently;
+        # the others prompt for codes one at a time
+        unattended = [
+            c for c in configs
+            if c.envdata.get("DEVENV_AWSENV_MFA_OTP_AUTHSECRET")
+        ]
+        interactive = [ c for c in configs if c not in unattended ]
+        results = []
+        if unattended:
+            with concurrent.futures.ThreadPoolExecutor(len(unattended)) as ex:
+                results.extend(ex.map(lambda c: c.auth(), unattended))
+        for c in interactive:
+            results.append(c.auth())
+        return 1 if any(results) else 0
+
+    def export_many(self, envs, format="sh"):
+        envs = list(dict.fromkeys(envs))
+        known = self.load_meta()["envs"]
+        for env in envs:
+            if not env in known:
+                self.errout(f"No such env {env}")
+                return 1
+        # e.g. "my-env" and "my_env" would silently overwrite each other
+        prefixes = {}
+        owners = {}
+        for env in envs:
+            name = re.sub(r"[^A-Z0-9]", "_", env.upper())
+            prefix = f"AWSENV_{name}"
+            if prefix in owners and format != "json":
+                self.errout(
+                    f"Envs {owners[prefix]} and {env} would both export as "
+                    f"{prefix}_*"
+                )
+                return 1
+            owners[prefix] = env
+            prefixes[env] = prefix
+        configs = [
+            self if env == self.current_env else self.for_env(env)
+            for env in envs
+        ]
+        if self.auth_many(configs):
+            return 1
+        if format == "json":
+            exported = { c.current_env: c.exported_vars() for c in configs }
+            self.out(json.dumps(exported, indent=4, sort_keys=True))
+            return
+        exported = {}
+        watch = []
+        for c in configs:
+            prefix = prefixes[c.current_env]
+            for k, v in c.exported_vars().items():
+                exported[f"{prefix}_{k}"] = v
+            watch.extend(c.watch_files())
+        render = EXPORT_FORMATS[format]
+        self.out("\n".join(render(exported, watch)))
+
+    def whoami_cache_path(self):
+        return os.path.join(self.state_dir, "whoami.json")
+
+    def load_whoami_cache(self):
+        try:
+            with open(self.whoami_cache_path()) as f:
+                cache = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        # drop expired and malformed entries
+        now = datetime.now(timezone.utc)
+        valid = {}
+        for k, v in cache.items():
+            if not (
+                    isinstance(v, dict) and
+                    isinstance(v.get("identity"), dict) and
+                    isinstance(v.get("expires"), str)
+            ):
+                continue
+            expires = parse_expiry(v["expires"])
+            if expires is not None and expires > now:
+                valid[k] = v
+        return valid
+
+    def save_whoami_cache(self, cache):
+        path = self.whoami_cache_path()
+        try:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+            fd = os.open(
+                f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f, indent=4, sort_keys=True)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass
+
+    def whoami(self, refresh=False):
+        creds = dict(self.envdata)
+        creds.update(self.derived)
+        if not (
+                creds.get("AWS_ACCESS_KEY_ID") and
+                creds.get("AWS_SECRET_ACCESS_KEY")
+        ):
+            self.errout(f"No AWS credentials set for {self.current_env}")
+            return 1
+        # cache by credentials, so it is invalidated by "awsenv auth"
+        cachekey = sha256hex(
+            creds["AWS_ACCESS_KEY_ID"] + "\0" +
+            creds.get("AWS_SESSION_TOKEN", "")
+        )
+        now = datetime.now(timezone.utc)
+        cache = self.load_whoami_cache()
+        if cachekey in cache and not refresh:
+            self.out(json.dumps(cache[cachekey]["identity"], indent=4))
+            return 0
+
+        region = creds.get("AWS_DEFAULT_REGION") or "us-east-1"
+        endpoint = os.environ.get(
+            "DEVENV_AWSENV_STS_ENDPOINT", f"https://sts.{region}.amazonaws.com/"
+        )
+        url, headers, body = caller_identity_request(
+            creds, region, endpoint, now
+        )
+        try:
+            response = self.post(url, headers, body)
+        except urllib.error.HTTPError as e:
+            try:
+                error = ElementTree.fromstring(e.read())
+                code = error.findtext(f".//{STS_NAMESPACE}Code")
+                message = error.findtext(f".//{STS_NAMESPACE}Message")
+                self.errout(f"GetCallerIdentity failed: {code}: {message}")
+            except ElementTree.ParseError:
+                self.errout(f"GetCallerIdentity failed: HTTP {e.code}")
+            return 1
+        except urllib.error.URLError as e:
+            self.errout(f"GetCallerIdentity failed: {e.reason}")
+            return 1
+
+        try:
+            result = ElementTree.fromstring(response).find(
+                f"{STS_NAMESPACE}GetCallerIdentityResult"
+            )
+        except ElementTree.ParseError:
+            result = None
+        if result is None:
+            self.errout("GetCallerIdentity failed: unexpected response")
+            return 1
+        identity = {
+            name: result.findtext(f"{STS_NAMESPACE}{name}")
+            for name in ("UserId", "Account", "Arn")
+        }
+        expires = self.session_expires()
+        if not creds.get("AWS_SESSION_TOKEN") or expires is None:
+            expires = now + timedelta(seconds=WHOAMI_TTL)
+        cache[cachekey] = {
+            "identity": identity,
+            "expires": expires.isoformat(),
+        }
+        self.save_whoami_cache(cache)
+        self.out(json.dumps(identity, indent=4))
+        return 0
+
+    def keyring_backend(self):
+        try:
+            return type(self.keyring.get_keyring()).__name__
+        except Exception:
+            return type(self.keyring).__name__
+
+    def record_event(self, command, duration, outcome):
+        event = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "command": command,
+            "env": self.current_env,
+            "host": socket.gethostname(),
+            "backend": self.keyring_backend(),
+            "duration": round(duration, 4),
+            "keyring_calls": self.keyring_calls,
+            "subprocess_time": round(self.subprocess_time, 4),
+            "outcome": outcome,
+        }
+        if command == "auth":
+            event["authenticated"] = self.authenticated
+        EventLog(self.state_dir).append(event)
 
     def run(self, cmd, **kw): # pragma: no cover
-        return subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            **kw
+        started = time.monotonic()
+        try:
+            return subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                **kw
+            )
+        finally:
+            self.subprocess_time += time.monotonic() - started
+
+    def post(self, url, headers, body): # pragma: no cover
+        request = urllib.request.Request(
+            url, data=body.encode("utf-8"), headers=headers, method="POST"
         )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.read()
 
     def call(self, cmd): # pragma: no cover
-        return subprocess.call(cmd)
+        started = time.monotonic()
+        try:
+            return subprocess.call(cmd)
+        finally:
+            self.subprocess_time += time.monotonic() - started
 
     def out(self, data): # pragma: no cover
         print(data)
@@ -351,12 +1216,22 @@ class Config:
         sys.stderr.flush()
 
     def inp(self, prompt): # pragma: no cover
-        return input(prompt)
+        # input() prompts on stdout when it isn't a tty, and stdout is often
+        # captured, e.g. by eval "$(awsenv export-many dev prod)"
+        sys.stderr.write(prompt)
+        sys.stderr.flush()
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip("\n")
 
     def which(self, cmd): # pragma: no cover
         return shutil.which(cmd)
 
-if __name__ == "__main__": # pragma: no cover
+    def sleep(self, seconds): # pragma: no cover
+        time.sleep(seconds)
+
+def main(): # pragma: no cover
     main_parser = argparse.ArgumentParser(description="awsenv")
     subparsers= main_parser.add_subparsers(
         dest="command",
@@ -376,6 +1251,13 @@ if __name__ == "__main__": # pragma: no cover
         action="store_true",
         default=False,
     )
+    auth_parser.add_argument(
+        "--if-expiring-within",
+        help="Also authenticate if the session expires within SECONDS",
+        metavar="SECONDS",
+        type=int,
+        default=None,
+    )
 
     list_parser = subparsers.add_parser(
         "list", help="Show all available environments"
@@ -401,10 +1283,82 @@ if __name__ == "__main__": # pragma: no cover
     export_parser = subparsers.add_parser(
         "export", help="Output shell commands to export the required envvars"
     )
+    export_parser.add_argument(
+        "--format",
+        help="Output format (default: sh)",
+        choices=sorted(EXPORT_FORMATS),
+        default="sh",
+    )
+    export_many_parser = subparsers.add_parser(
+        "export-many",
+        help=(
+            "Output the envvars of several environments, prefixed with "
+            "AWSENV_<ENV>_ (or as a JSON object keyed by environment)"
+        )
+    )
+    export_many_parser.add_argument(
+        "envs", help="Environment names", nargs="+", metavar="env"
+    )
+    export_many_parser.add_argument(
+        "--format",
+        help="Output format (default: sh)",
+        choices=sorted(EXPORT_FORMATS),
+        default="sh",
+    )
     mfaleft_parser = subparsers.add_parser(
         "mfaleft",
         help="Show how much time is left in the current MFA session (hh:mm)"
     )
+    mfaleft_format = mfaleft_parser.add_mutually_exclusive_group()
+    mfaleft_format.add_argument(
+        "--seconds",
+        help="Show whole seconds left (negative if expired, 0 if no session)",
+        action="store_true",
+        default=False,
+    )
+    mfaleft_format.add_argument(
+        "--json",
+        help="Show the expiry time, seconds left and expired flag as JSON",
+        action="store_true",
+        default=False,
+    )
+    set_parser = subparsers.add_parser(
+        "set", help="Change values in an environment without an editor"
+    )
+    set_parser.add_argument(
+        "assignments", help="KEY=VALUE pairs", nargs="+", metavar="KEY=VALUE"
+    )
+    set_parser.add_argument(
+        "--env",
+        help="Change this environment instead of the current one (repeatable)",
+        action="append",
+        dest="envs",
+    )
+
+    whoami_parser = subparsers.add_parser(
+        "whoami",
+        help="Show the AWS identity of the current credentials (cached)"
+    )
+    whoami_parser.add_argument(
+        "--refresh",
+        help="Ask STS even if a cached identity is available",
+        action="store_true",
+        default=False,
+    )
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="Summarize the auth/export/edit event log"
+    )
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Keep per-env session status files up to date (runs forever)"
+    )
+    watch_parser.add_argument(
+        "--refresh",
+        help="Reauthenticate expiring sessions that have an OTP auth secret",
+        action="store_true",
+        default=False,
+    )
 
     args = main_parser.parse_args()
 
@@ -413,34 +1367,89 @@ if __name__ == "__main__": # pragma: no cover
     except ImportError:
         keyring = None # for tests
 
+    if args.command == "stats":
+        sys.exit(EventLog(get_state_dir()).stats(print))
+
+    if args.command == "watch":
+        # every shell may start a watcher; bail out before touching the
+        # keyring if one is already running
+        watch_lock = acquire_watch_lock(get_state_dir())
+        if watch_lock is None:
+            sys.stderr.write("awsenv watch is already running\n")
+            sys.exit(0)
+
+    started = time.monotonic()
     env = os.environ.get("DEVENV_AWSENV")
-    config = Config(env, keyring)
+    try:
+        config = Config(env, keyring)
+    except Exception:
+        if args.command in LOGGED_COMMANDS:
+            EventLog(get_state_dir()).append({
+                "command": args.command,
+                "env": env,
+                "host": socket.gethostname(),
+                "duration": round(time.monotonic() - started, 4),
+                "outcome": "exception",
+            })
+        raise
 
     def exit(returncode):
         if returncode is None:
             returncode = 0
+        if args.command in LOGGED_COMMANDS:
+            outcome = "ok" if returncode == 0 else "error"
+            config.record_event(
+                args.command, time.monotonic() - started, outcome
+            )
         sys.exit(returncode)
 
-    if not args.command:
-        print(config.current_env)
+    try:
+        if not args.command:
+            print(config.current_env)
+
+        if args.command == "edit":
+            exit(config.edit())
+
+        if args.command == "auth":
+            exit(config.auth(args.force, args.if_expiring_within))
 
-    if args.command == "edit":
-        exit(config.edit())
+        if args.command == "mfaleft":
+            if args.json:
+                exit(print(json.dumps(config.mfastatus(), indent=4)))
+            if args.seconds:
+                left = config.seconds_left()
+                exit(print(0 if left is None else int(left)))
+            exit(print(config.mfaleft()))
 
-    if args.command == "auth":
-        exit(config.auth(args.force))
+        if args.command == "list":
+            exit(config.list())
 
-    if args.command == "mfaleft":
-        exit(print(config.mfaleft()))
+        if args.command == "delete":
+            exit(config.delete(args.name))
 
-    if args.command == "list":
-        exit(config.list())
+        if args.command == "copy":
+            exit(config.copy(args.source, args.target))
 
-    if args.command == "delete":
-        exit(config.delete(args.name))
+        if args.command == "export":
+            exit(config.export(args.format))
 
-    if args.command == "copy":
-        exit(config.copy(args.source, args.target))
+        if args.command == "export-many":
+            exit(config.export_many(args.envs, args.format))
 
-    if args.command == "export":
-        exit(config.export())
+        if args.command == "set":
+            exit(config.set_keys(args.assignments, args.envs))
+
+        if args.command == "whoami":
+            exit(config.whoami(args.refresh))
+
+        if args.command == "watch":
+            exit(config.watch(args.refresh))
+    except Exception:
+        if args.command in LOGGED_COMMANDS:
+            config.record_event(
+                args.command, time.monotonic() - started, "exception"
+            )
+        raise
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -23,6 +23,30 @@
       description = "Manage the AWS_PROFILE envvar and add profiles to ~/.aws";
       default = false;
     };
+    kernel-keyring = lib.mkOption {
+      type = lib.types.nullOr (lib.types.enum [ "user" "session" ]);
+      description = ''
+        Linux only (ignored elsewhere): also cache MFA session credentials in
+        this kernel keyring (see keyctl(1)) until they expire
+      '';
+      default = null;
+    };
+    watch = lib.mkOption {
+      type = lib.types.bool;
+      description = ''
+        Start a per-user "awsenv watch" process with the shell that keeps
+        session status files up to date for prompts
+      '';
+      default = false;
+    };
+    watch-refresh = lib.mkOption {
+      type = lib.types.bool;
+      description = ''
+        Let "awsenv watch" reauthenticate expiring sessions of environments
+        that have an OTP auth secret
+      '';
+      default = false;
+    };
   };
   config =
     let
@@ -41,46 +65,86 @@
       # whatever reason, the cryptography package has a python-3.11 DLL instead
       # of a python-3.12 one in Nix.
       #
+      awsenv_runtime_modules = python-pkgs: [
+        python-pkgs.keyring
+        python-pkgs.keyrings-alt
+        python-pkgs.pyotp
+      ] ++ lib.optionals pkgs.stdenv.isLinux [
+        python-pkgs.dbus-python
+        python-pkgs.secretstorage
+      ];
       awsenv_python = (
-        pkgs.python311.withPackages (python-pkgs: [
-          python-pkgs.keyring
-          python-pkgs.keyrings-alt
-          python-pkgs.pyotp
-          python-pkgs.pytest
-          python-pkgs.coverage
-          python-pkgs.pytest-cov
-        ] ++ lib.optionals pkgs.stdenv.isLinux [
-          python-pkgs.dbus-python
-          python-pkgs.secretstorage
-        ]
+        pkgs.python311.withPackages (python-pkgs:
+          (awsenv_runtime_modules python-pkgs) ++ [
+            python-pkgs.pytest
+            python-pkgs.coverage
+            python-pkgs.pytest-cov
+          ]
         )
       );
+      # The packaged awsenv command: awsenv.py precompiled to bytecode and
+      # started in isolated mode without the site module (python -I -S), with
+      # only its runtime modules (and their dependencies) on sys.path instead
+      # of the whole withPackages site-packages.  Bytecode uses unchecked-hash
+      # invalidation because Nix resets source mtimes in the store.
+      awsenv_pythonpath = pkgs.python311.pkgs.makePythonPath (
+        pkgs.python311.pkgs.requiredPythonModules (
+          awsenv_runtime_modules pkgs.python311.pkgs
+        )
+      );
+      awsenv_app = pkgs.runCommand "devenv-awsenv" {} ''
+        mkdir -p $out/lib $out/bin
+        cp ${./awsenv.py} $out/lib/awsenv.py
+        cat > $out/bin/awsenv <<EOF
+        import sys
+        sys.path[:0] = ["$out/lib"] + "${awsenv_pythonpath}".split(":")
+        import awsenv
+        awsenv.main()
+        EOF
+        ${pkgs.python311}/bin/python -I -m compileall -q \
+          --invalidation-mode unchecked-hash $out/lib
+      '';
       awsenvpyexe = "${awsenv_python}/bin/python";
     in
       lib.mkIf cfg.enable {
-        scripts.awsenv.exec = lib.mkDefault ''exec ${awsenvpyexe} "${./awsenv.py}" $@'';
+        scripts.awsenv.exec = lib.mkDefault
+          ''exec ${pkgs.python311}/bin/python -I -S ${awsenv_app}/bin/awsenv "$@"'';
         scripts.awsenvpyexe.exec = lib.mkDefault ''exec ${awsenvpyexe} $@'';
         scripts.awsenv-aws.exec = lib.mkDefault ''exec ${cfg.package}/bin/aws $@'';
         scripts."run-awsenv-tests".exec = lib.mkDefault
           ''exec ${awsenv_python}/bin/py.test --cov=awsenv --cov-report=term-missing test.py $@'';
+        scripts."run-awsenv-stress".exec = lib.mkDefault
+          ''exec ${awsenv_python}/bin/python stress.py $@'';
         scripts.awsenv-callerident.exec = lib.mkDefault ''
-          exec awsenv-aws sts get-caller-identity
+          exec awsenv whoami "$@"
         '';
         env = let
           manage_profiles = if cfg.manage-profiles then {
             DEVENV_AWSENV_MANAGE_PROFILES = lib.mkDefault "1";
           } else {};
+          # keyutils only builds on Linux; elsewhere the option is ignored
+          kernel_keyring = lib.optionalAttrs
+            (cfg.kernel-keyring != null && pkgs.stdenv.isLinux) {
+              DEVENV_AWSENV_KERNEL_KEYRING = lib.mkDefault (
+                if cfg.kernel-keyring == "user" then "@u" else "@s"
+              );
+              DEVENV_AWSENV_KEYCTL =
+                lib.mkDefault "${pkgs.keyutils}/bin/keyctl";
+            };
         in
           {
             DEVENV_AWSENV_TEMPLATE = lib.mkDefault ./template.json;
             DEVENV_AWSENV = cfg.env;
-          } // manage_profiles;
+          } // manage_profiles // kernel_keyring;
 
-        enterShell = lib.mkBefore ''
+        enterShell = lib.mkBefore (lib.optionalString cfg.watch ''
+          (awsenv watch ${lib.optionalString cfg.watch-refresh "--refresh"} \
+            </dev/null >/dev/null 2>&1 &)
+        '' + ''
           awsenv auth && \
           eval "$(awsenv export)" && \
           echo "⏹️  AWS envvars set for $DEVENV_AWSENV" || \
           echo "✖️  Could not export AWS envvars"
-        '';
+        '');
       };
 }
@@ -6,6 +6,9 @@
   awsenv.enable = true;
   awsenv.env = "testenv";
 
+  # the previous, unpackaged way of running awsenv, for startup comparison
+  scripts.awsenv-source.exec = ''exec awsenvpyexe "$DEVENV_ROOT/awsenv.py" "$@"'';
+
   enterShell = ''
     [ "$(awsenv)" == "testenv" ] && echo "enterShell works" || exit 2
     awsenv export | grep DEVENV_AWSENV || exit 2
@@ -17,5 +20,26 @@
     awsenvpyexe -m coverage report -m \
       --fail-under=100 \
       --include="test.py,awsenv.py"
+    DEVENV_AWSENV_STATE_DIR="$(mktemp -d)" awsenvpyexe - <<'EOF'
+    import statistics, subprocess, time
+
+    def startup(cmd, runs=20):
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run(cmd, stdout=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - started)
+        return statistics.median(samples)
+
+    # "stats" imports keyring but doesn't touch the keychain
+    packaged = startup(["awsenv", "stats"])
+    source = startup(["awsenv-source", "stats"])
+    print(
+        f"awsenv startup (median): packaged {packaged * 1000:.1f}ms, "
+        f"source wrapper {source * 1000:.1f}ms"
+    )
+    if packaged > source * 1.1:
+        raise SystemExit("packaged awsenv starts slower than the source wrapper")
+    EOF
   '';
 }
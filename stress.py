@@ -0,0 +1,230 @@
+"""
+Stress test for many shells starting at once.
+
+Starts N concurrent ``awsenv`` processes running a mix of ``auth``,
+``export``, ``copy`` and ``delete`` against a file-backed fake keyring and a
+local stub of ``awsenv-aws sts get-session-token``, for increasing N.  After
+each round it checks that no envs were lost from ``__meta__`` and that the
+expired session was only refreshed by a single STS call, and it reports
+throughput and latency.
+
+Usage: python stress.py [--max-procs 32]
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import keyring.backend
+
+from awsenv import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+OTP_AUTHSECRET = "E2OVN6XH7LXUR22ZQ64MAEM2NQ22JEKILF3QUV7W7S6JHYL5BZVAFZNDDLSRW3AZ"
+
+STS_STUB = """#!{python}
+import json, os, sys
+from datetime import datetime, timedelta, timezone
+with open({calls!r}, "a") as f:
+    f.write(json.dumps(sys.argv[1:]) + "\\n")
+expires = datetime.now(timezone.utc) + timedelta(hours=12)
+print(json.dumps({{"Credentials": {{
+    "SessionToken": "token",
+    "SecretAccessKey": "secret",
+    "AccessKeyId": "ASIA",
+    "Expiration": expires.isoformat(),
+}}}}))
+"""
+
+class FileKeyring(keyring.backend.KeyringBackend):
+    """ A keyring backend storing passwords in the JSON file named by
+    ``AWSENV_STRESS_KEYRING``, each operation under an exclusive flock """
+    priority = 1
+
+    def transact(self, change=None):
+        path = os.environ["AWSENV_STRESS_KEYRING"]
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(path) as f:
+                data = json.load(f)
+            if change is None:
+                return data
+            change(data)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(f"{path}.tmp", path)
+
+    def get_password(self, service, username):
+        return self.transact().get(username)
+
+    def set_password(self, service, username, password):
+        def change(data):
+            data[username] = password
+        self.transact(change)
+
+    def delete_password(self, service, username):
+        def change(data):
+            data.pop(username, None)
+        self.transact(change)
+
+def setup(workdir, nprocs):
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    calls = os.path.join(workdir, "sts-calls")
+    open(calls, "w").close()
+    stub = os.path.join(bindir, "awsenv-aws")
+    with open(stub, "w") as f:
+        f.write(STS_STUB.format(python=sys.executable, calls=calls))
+    os.chmod(stub, 0o755)
+
+    base = {
+        "AWS_ACCESS_KEY_ID": "AKIA",
+        "AWS_ACCOUNT_ID": "123456789012",
+        "AWS_DEFAULT_OUTPUT": "json",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_SECRET_ACCESS_KEY": "secret",
+        "DEVENV_AWSENV_MFA_DEVICE": "device",
+        "DEVENV_AWSENV_MFA_OTP_AUTHSECRET": OTP_AUTHSECRET,
+    }
+    data = {
+        "base": json.dumps(base),
+        "base-derived": json.dumps(
+            {"AWS_SESSION_EXPIRES": "2022-01-01T00:00:00+00:00"}
+        ),
+    }
+    envs = ["base"]
+    for n in range(nprocs):
+        if operation(n)[0] == "delete":
+            data[f"d{n}"] = json.dumps(base)
+            data[f"d{n}-derived"] = "{}"
+            envs.append(f"d{n}")
+    data["__meta__"] = json.dumps({"envs": envs})
+    keyring_path = os.path.join(workdir, "keyring.json")
+    with open(keyring_path, "w") as f:
+        json.dump(data, f)
+
+    env = dict(os.environ)
+    env.update({
+        "PATH": bindir + os.pathsep + env.get("PATH", ""),
+        "PYTHONPATH": HERE,
+        "PYTHON_KEYRING_BACKEND": "stress.FileKeyring",
+        "AWSENV_STRESS_KEYRING": keyring_path,
+        "DEVENV_AWSENV": "base",
+        "DEVENV_AWSENV_TEMPLATE": os.path.join(HERE, "template.json"),
+        "DEVENV_AWSENV_STATE_DIR": os.path.join(workdir, "state"),
+        "DEVENV_AWSENV_EARLY_REFRESH": "0",
+    })
+    env.pop("DEVENV_AWSENV_KERNEL_KEYRING", None)
+    return env, keyring_path, calls
+
+def operation(n):
+    return (
+        ["auth"],
+        ["export"],
+        ["copy", "base", f"c{n}"],
+        ["delete", f"d{n}"],
+    )[n % 4]
+
+def run_round(nprocs):
+    workdir = tempfile.mkdtemp(prefix="awsenv-stress-")
+    try:
+        env, keyring_path, calls = setup(workdir, nprocs)
+        barrier = threading.Barrier(nprocs)
+        results = [None] * nprocs
+
+        def worker(n):
+            cmd = [sys.executable, os.path.join(HERE, "awsenv.py")]
+            cmd.extend(operation(n))
+            barrier.wait()
+            started = time.perf_counter()
+            proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+            results[n] = (time.perf_counter() - started, proc)
+
+        threads = [
+            threading.Thread(target=worker, args=(n,)) for n in range(nprocs)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        with open(keyring_path) as f:
+            data = json.load(f)
+        expected = set(["base"])
+        for n in range(nprocs):
+            if operation(n)[0] == "copy":
+                expected.add(f"c{n}")
+        actual = set(json.loads(data["__meta__"])["envs"])
+        with open(calls) as f:
+            sts_calls = len(f.readlines())
+
+        problems = []
+        for n, (_, proc) in enumerate(results):
+            if proc.returncode != 0:
+                problems.append(
+                    f"{' '.join(operation(n))} exited {proc.returncode}: "
+                    f"{proc.stderr.strip()[-200:]}"
+                )
+        if expected - actual:
+            problems.append(f"lost envs: {sorted(expected - actual)}")
+        if actual - expected:
+            problems.append(f"unexpected envs: {sorted(actual - expected)}")
+        missing = [ env for env in expected if env not in data ]
+        if missing:
+            problems.append(f"envs without data: {sorted(missing)}")
+        if sts_calls != 1:
+            problems.append(f"{sts_calls} STS calls for one expired session")
+
+        latencies = [ latency for latency, _ in results ]
+        return {
+            "nprocs": nprocs,
+            "wall": wall,
+            "throughput": nprocs / wall,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "max": max(latencies),
+            "problems": problems,
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--max-procs",
+        help="Largest number of concurrent processes (default: 32)",
+        type=int,
+        default=32,
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'procs':>5} {'wall':>8} {'ops/s':>7} "
+        f"{'p50':>8} {'p95':>8} {'max':>8}  invariants"
+    )
+    failed = False
+    nprocs = 1
+    while nprocs <= args.max_procs:
+        r = run_round(nprocs)
+        status = "ok" if not r["problems"] else "FAILED"
+        print(
+            f"{r['nprocs']:>5} {r['wall']:>7.2f}s {r['throughput']:>7.1f} "
+            f"{r['p50']:>7.3f}s {r['p95']:>7.3f}s {r['max']:>7.3f}s  {status}"
+        )
+        for problem in r["problems"]:
+            failed = True
+            print(f"      {problem}")
+        nprocs *= 2
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
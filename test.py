@@ -1,6 +1,9 @@
+from datetime import datetime, timedelta, timezone
 import json
 import os
+import tempfile
 import unittest
+from unittest import mock
 
 class FakeErrors:
     InitError = Exception
@@ -31,6 +34,37 @@ class FakeKeyring:
     def delete_password(self, ourname, key):
         self.envs.pop(key, None)
 
+class FakeResult:
+    def __init__(self, returncode=0, stdout='', stderr=''):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+class FakeKeyctl:
+    def __init__(self):
+        self.keys = {}
+        self.timeouts = {}
+        self.commands = []
+
+    def __call__(self, cmd, **kw):
+        self.commands.append(cmd)
+        op = cmd[1]
+        if op == "pipe":
+            desc = cmd[2].split(":", 1)[1]
+            if desc not in self.keys:
+                return FakeResult(1, stderr="Required key not available")
+            return FakeResult(0, self.keys[desc])
+        if op == "padd":
+            self.keys[cmd[3]] = kw["input"]
+            return FakeResult(0, f"{cmd[3]}\n")
+        if op == "timeout":
+            self.timeouts[cmd[2]] = int(cmd[3])
+            return FakeResult(0)
+        if op == "invalidate":
+            desc = cmd[2].split(":", 1)[1]
+            self.keys.pop(desc, None)
+            return FakeResult(0)
+
 class TestConfig(unittest.TestCase):
     def __init__(self, name):
         super().__init__(name)
@@ -38,6 +72,14 @@ class TestConfig(unittest.TestCase):
         self.template_path = os.path.join(here, "template.json")
         os.environ["DEVENV_AWSENV_TEMPLATE"] = self.template_path
 
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.state_dir = self.tempdir.name
+        os.environ["DEVENV_AWSENV_STATE_DIR"] = self.state_dir
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
     def _makeOne(self, env, keyring=None):
         from awsenv import Config
         if keyring is None:
@@ -322,6 +364,71 @@ class TestConfig(unittest.TestCase):
         config.derived["AWS_SESSION_EXPIRES"] = '2037-01-01T08:57:37+00:00'
         self.assertTrue("days" in config.mfaleft())
 
+    def _expiresIn(self, **kw):
+        expires = datetime.now(timezone.utc) + timedelta(**kw)
+        return {"AWS_SESSION_EXPIRES": expires.isoformat()}
+
+    def test_mfaleft_hours(self):
+        config = self._makeOne("profile")
+        config.derived.update(self._expiresIn(hours=3, minutes=5, seconds=30))
+        self.assertEqual(config.mfaleft(), "3:05")
+
+    def test_mfaleft_one_day(self):
+        config = self._makeOne("profile")
+        config.derived.update(self._expiresIn(days=1, minutes=7, seconds=30))
+        self.assertEqual(config.mfaleft(), "1 day, 0:07")
+
+    def test_mfaleft_days(self):
+        config = self._makeOne("profile")
+        config.derived.update(self._expiresIn(days=2, hours=1, seconds=30))
+        self.assertEqual(config.mfaleft(), "2 days, 1:00")
+
+    def test_mfaleft_expired(self):
+        config = self._makeOne("profile")
+        config.derived.update(self._expiresIn(minutes=-5, seconds=-30))
+        self.assertEqual(config.mfaleft(), "-0:05")
+
+    def test_seconds_left_no_session(self):
+        config = self._makeOne("profile")
+        self.assertEqual(config.seconds_left(), None)
+        self.assertEqual(config.expires_within(0), True)
+
+    def test_seconds_left(self):
+        config = self._makeOne("profile")
+        config.derived.update(self._expiresIn(seconds=100))
+        self.assertTrue(95 < config.seconds_left() <= 100)
+        self.assertEqual(config.expires_within(60), False)
+        self.assertEqual(config.expires_within(120), True)
+
+    def test_session_expires_naive_is_utc(self):
+        config = self._makeOne("profile")
+        config.derived["AWS_SESSION_EXPIRES"] = '2037-01-01T08:57:37'
+        self.assertEqual(
+            config.session_expires(),
+            datetime(2037, 1, 1, 8, 57, 37, tzinfo=timezone.utc)
+        )
+
+    def test_mfastatus(self):
+        config = self._makeOne("profile")
+        config.derived["AWS_SESSION_EXPIRES"] = '2022-01-01T08:57:37+00:00'
+        status = config.mfastatus()
+        self.assertEqual(status["env"], "profile")
+        self.assertEqual(status["expires"], '2022-01-01T08:57:37+00:00')
+        self.assertTrue(status["seconds_left"] < 0)
+        self.assertEqual(status["expired"], True)
+
+    def test_mfastatus_no_session(self):
+        config = self._makeOne("profile")
+        self.assertEqual(
+            config.mfastatus(),
+            {
+                "env": "profile",
+                "expires": None,
+                "seconds_left": None,
+                "expired": True,
+            }
+        )
+
     def test_mfa_expired_no_aws_session_expires(self):
         config = self._makeOne("profile")
         self.assertEqual(config.mfa_expired(), True)
@@ -470,5 +577,1245 @@ class TestConfig(unittest.TestCase):
              }
         )
 
+    def _makeKernelCached(self, env):
+        config = self._makeOne(env)
+        config.kernel_keyring = "@u"
+        config.run = FakeKeyctl()
+        return config
+
+    def test_seconds_left_of_derived(self):
+        config = self._makeOne("profile")
+        derived = {"AWS_SESSION_EXPIRES": "2037-01-01T08:57:37+00:00"}
+        self.assertTrue(config.seconds_left(derived) > 0)
+        self.assertEqual(config.seconds_left(), None)
+
+    def test_seconds_left_unparseable(self):
+        config = self._makeOne("profile")
+        derived = {"AWS_SESSION_EXPIRES": "expires"}
+        self.assertEqual(config.seconds_left(derived), None)
+
+    def test_seconds_left_not_a_dict(self):
+        config = self._makeOne("profile")
+        self.assertEqual(config.seconds_left([]), None)
+
+    def test_kernel_cache_disabled(self):
+        config = self._makeOne("profile")
+        self.assertEqual(config.cache_get("profile-derived"), None)
+        self.assertEqual(config.cache_set("profile-derived", "{}", 5), None)
+        self.assertEqual(config.cache_delete("profile-derived"), None)
+
+    def test_save_derived_caches_session(self):
+        config = self._makeKernelCached("profile")
+        derived = json.dumps(
+            {"AWS_SESSION_EXPIRES": "2037-01-01T08:57:37+00:00"}
+        )
+        config.save_derived("profile", derived)
+        desc = "devenv-awsenv:profile-derived"
+        self.assertEqual(config.run.keys[desc], derived)
+        self.assertTrue(config.run.timeouts[desc] > 0)
+        self.assertEqual(config.keyring.envs["profile-derived"], derived)
+
+    def test_save_derived_without_session_invalidates(self):
+        config = self._makeKernelCached("profile")
+        desc = "devenv-awsenv:profile-derived"
+        config.run.keys[desc] = "{}"
+        config.save_derived("profile", "{}")
+        self.assertFalse(desc in config.run.keys)
+
+    def test_load_derived_cache_hit(self):
+        config = self._makeKernelCached("profile")
+        cached = {"AWS_SESSION_EXPIRES": "2037-01-01T08:57:37+00:00"}
+        config.run.keys["devenv-awsenv:profile-derived"] = json.dumps(cached)
+        reads = []
+        config.keyring.get_password = lambda *arg: reads.append(arg)
+        self.assertEqual(config.load_derived("profile"), cached)
+        # the persistent keyring is not read
+        self.assertEqual(reads, [])
+
+    def test_load_derived_cache_miss_populates(self):
+        config = self._makeKernelCached("profile")
+        persisted = {"AWS_SESSION_EXPIRES": "2037-01-01T08:57:37+00:00"}
+        config.keyring.envs["profile-derived"] = json.dumps(persisted)
+        self.assertEqual(config.load_derived("profile"), persisted)
+        desc = "devenv-awsenv:profile-derived"
+        self.assertEqual(json.loads(config.run.keys[desc]), persisted)
+
+    def test_load_derived_cache_miss_expired_not_cached(self):
+        config = self._makeKernelCached("profile")
+        persisted = {"AWS_SESSION_EXPIRES": "2022-01-01T08:57:37+00:00"}
+        config.keyring.envs["profile-derived"] = json.dumps(persisted)
+        self.assertEqual(config.load_derived("profile"), persisted)
+        self.assertEqual(config.run.keys, {})
+
+    def test_load_derived_cache_malformed(self):
+        config = self._makeKernelCached("profile")
+        config.run.keys["devenv-awsenv:profile-derived"] = "{malformed"
+        self.assertEqual(config.load_derived("profile"), {})
+
+    def test_cache_set_padd_fails(self):
+        config = self._makeKernelCached("profile")
+        config.run = lambda cmd, **kw: FakeResult(1)
+        config.cache_set("profile-derived", "{}", 5)
+
+    def test_keyctl_missing_disables_cache(self):
+        config = self._makeKernelCached("profile")
+        def run(cmd, **kw):
+            raise FileNotFoundError(cmd[0])
+        config.run = run
+        self.assertEqual(config.cache_get("profile-derived"), None)
+        self.assertEqual(config.kernel_keyring, None)
+
+    def test_delete_invalidates_kernel_cache(self):
+        config = self._makeKernelCached("profile")
+        config.keyring.envs["another"] = "{}"
+        config.keyring.envs["another-derived"] = "{}"
+        meta = json.loads(config.keyring.meta)
+        meta["envs"] = ["profile", "another"]
+        config.keyring.meta = json.dumps(meta)
+        config.run.keys["devenv-awsenv:another-derived"] = "{}"
+        config.delete("another")
+        self.assertEqual(config.run.keys, {})
+
+    def _makeStsFailing(self, *results, authsecret=True):
+        config = self._makeOne("profile")
+        config.envdata["DEVENV_AWSENV_MFA_DEVICE"] = "device"
+        if authsecret:
+            config.envdata["DEVENV_AWSENV_MFA_OTP_AUTHSECRET"] = "E2OVN6XH7LXUR22ZQ64MAEM2NQ22JEKILF3QUV7W7S6JHYL5BZVAFZNDDLSRW3AZ"
+        config.envdata["AWS_ACCOUNT_ID"] = '123'
+        config.derived["AWS_SESSION_EXPIRES"] = '2022-01-01T08:57:37+00:00'
+        config.which = lambda cmd: cmd
+        config.prompts = []
+        config.inp = lambda x: config.prompts.append(x) or "12345"
+        config.errors = []
+        config.errout = config.errors.append
+        config.sleeps = []
+        config.sleep = config.sleeps.append
+        results = list(results)
+        config.sts_calls = 0
+        def run(cmd, env):
+            config.sts_calls += 1
+            return results.pop(0)
+        config.run = run
+        return config
+
+    def _stsSuccess(self):
+        stdout = json.dumps(
+            {"Credentials":
+             {
+                 "SessionToken": "token",
+                 "SecretAccessKey": "key",
+                 "AccessKeyId": "id",
+                 "Expiration": "expires",
+             }
+             }
+        )
+        return FakeResult(0, stdout)
+
+    def test_classify_sts_error(self):
+        config = self._makeOne("profile")
+        self.assertEqual(
+            config.classify_sts_error(
+                "An error occurred (Throttling) when calling the "
+                "GetSessionToken operation: Rate exceeded"
+            ),
+            "throttled"
+        )
+        self.assertEqual(
+            config.classify_sts_error(
+                "An error occurred (AccessDenied) when calling the "
+                "GetSessionToken operation: MultiFactorAuthentication failed "
+                "with invalid MFA one time pass code."
+            ),
+            "bad-code"
+        )
+        self.assertEqual(
+            config.classify_sts_error(
+                "An error occurred (SignatureDoesNotMatch) when calling the "
+                "GetSessionToken operation: Signature expired"
+            ),
+            "clock-skew"
+        )
+        self.assertEqual(
+            config.classify_sts_error(
+                'Could not connect to the endpoint URL: "https://sts.amazonaws.com/"'
+            ),
+            "network"
+        )
+        self.assertEqual(config.classify_sts_error("boom"), "unknown")
+        self.assertEqual(config.classify_sts_error(None), "unknown")
+
+    def test_backoff_bounds(self):
+        config = self._makeOne("profile")
+        for attempt in range(10):
+            delay = config.backoff(attempt)
+            self.assertTrue(0 <= delay <= min(30.0, 2 ** attempt))
+
+    def test_auth_throttled_then_success(self):
+        config = self._makeStsFailing(
+            FakeResult(254, stderr="(Throttling) Rate exceeded"),
+            self._stsSuccess(),
+        )
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.sts_calls, 2)
+        self.assertEqual(len(config.sleeps), 1)
+        self.assertEqual(config.derived["AWS_SESSION_TOKEN"], "token")
+
+    def test_auth_throttled_then_success_interactive(self):
+        throttled = FakeResult(254, stderr="(Throttling) Rate exceeded")
+        config = self._makeStsFailing(
+            throttled, throttled, self._stsSuccess(), authsecret=False
+        )
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.sts_calls, 3)
+        # the typed code is reused for every retry
+        self.assertEqual(len(config.prompts), 1)
+
+    def test_auth_throttled_gives_up(self):
+        throttled = FakeResult(254, stderr="(Throttling) Rate exceeded")
+        config = self._makeStsFailing(*([throttled] * 6))
+        self.assertEqual(config.auth(), 1)
+        self.assertEqual(config.sts_calls, 6)
+        self.assertEqual(len(config.sleeps), 5)
+        self.assertEqual(config.errors[-1], "Giving up after 5 retries")
+
+    def test_auth_network_gives_up_interactive(self):
+        down = FakeResult(255, stderr="Connect timeout on endpoint URL")
+        config = self._makeStsFailing(*([down] * 6), authsecret=False)
+        self.assertEqual(config.auth(), 1)
+        self.assertEqual(config.sts_calls, 6)
+        self.assertEqual(len(config.prompts), 1)
+
+    def test_auth_clock_skew(self):
+        config = self._makeStsFailing(
+            FakeResult(254, stderr="(RequestTimeTooSkewed)"),
+        )
+        self.assertEqual(config.auth(), 1)
+        self.assertEqual(config.sleeps, [])
+        self.assertTrue("clock is skewed" in config.errors[-1])
+
+    def test_auth_bad_code_with_authsecret(self):
+        config = self._makeStsFailing(
+            FakeResult(254, stderr="MultiFactorAuthentication failed"),
+        )
+        self.assertEqual(config.auth(), 1)
+        self.assertEqual(config.sleeps, [])
+
+    def test_auth_bad_code_interactive_reprompts(self):
+        config = self._makeStsFailing(
+            FakeResult(254, stderr="MultiFactorAuthentication failed"),
+            self._stsSuccess(),
+            authsecret=False,
+        )
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.sts_calls, 2)
+        self.assertEqual(config.sleeps, [])
+        self.assertEqual(len(config.prompts), 2)
+
+    def test_auth_unknown_error_interactive(self):
+        config = self._makeStsFailing(
+            FakeResult(254, stderr="(AccessDenied) not allowed"),
+            self._stsSuccess(),
+            authsecret=False,
+        )
+        self.assertEqual(config.auth(), 1)
+        self.assertEqual(config.sts_calls, 1)
+        self.assertEqual(config.sleeps, [])
+
+    def test_auth_early_refresh_with_authsecret(self):
+        config = self._makeStsFailing(self._stsSuccess())
+        soon = datetime.now(timezone.utc) + timedelta(seconds=60)
+        config.derived["AWS_SESSION_EXPIRES"] = soon.isoformat()
+        config.refresh_offset = lambda: 120
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.sts_calls, 1)
+
+    def test_auth_if_expiring_within(self):
+        config = self._makeStsFailing(self._stsSuccess(), authsecret=False)
+        config.derived.update(self._expiresIn(seconds=600))
+        self.assertEqual(config.auth(within=300), 0)
+        self.assertEqual(config.sts_calls, 0)
+        self.assertEqual(config.auth(within=900), 0)
+        self.assertEqual(config.sts_calls, 1)
+
+    def test_auth_no_early_refresh_outside_window(self):
+        config = self._makeStsFailing()
+        soon = datetime.now(timezone.utc) + timedelta(seconds=600)
+        config.derived["AWS_SESSION_EXPIRES"] = soon.isoformat()
+        config.early_refresh = 300
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.sts_calls, 0)
+
+    def test_keyring_calls_counted(self):
+        config = self._makeOne("profile")
+        before = config.keyring_calls
+        config.get_password("profile")
+        config.set_password("profile", "{}")
+        config.delete_password("profile")
+        self.assertEqual(config.keyring_calls, before + 3)
+
+    def test_keyring_backend_fallback(self):
+        config = self._makeOne("profile")
+        self.assertEqual(config.keyring_backend(), "FakeKeyring")
+
+    def test_keyring_backend_from_keyring_module(self):
+        config = self._makeOne("profile")
+        class Backend:
+            pass
+        config.keyring.get_keyring = lambda: Backend()
+        self.assertEqual(config.keyring_backend(), "Backend")
+
+    def test_record_event(self):
+        config = self._makeOne("profile")
+        with tempfile.TemporaryDirectory() as state_dir:
+            config.state_dir = state_dir
+            config.authenticated = True
+            config.record_event("auth", 1.5, "ok")
+            from awsenv import EventLog
+            events = EventLog(state_dir).load()
+        self.assertEqual(len(events), 1)
+        event = events[0]
+        self.assertEqual(event["command"], "auth")
+        self.assertEqual(event["env"], "profile")
+        self.assertEqual(event["duration"], 1.5)
+        self.assertEqual(event["outcome"], "ok")
+        self.assertEqual(event["authenticated"], True)
+        self.assertTrue(event["keyring_calls"] > 0)
+
+    def _makeExportable(self):
+        config = self._makeOne("profile")
+        config.envdata = {
+            "AWS_ACCESS_KEY_ID": "id",
+            "AWS_SECRET_ACCESS_KEY": "it's a \\secret",
+            "DEVENV_AWSENV_MFA_DEVICE": "device",
+        }
+        config.derived = {}
+        config.capture = []
+        config.out = config.capture.append
+        return config
+
+    def test_export_single_write(self):
+        config = self._makeExportable()
+        config.export()
+        self.assertEqual(len(config.capture), 1)
+
+    def test_export_fish(self):
+        config = self._makeExportable()
+        config.export("fish")
+        self.assertEqual(
+            config.capture[0].splitlines(),
+            [
+                "set -gx AWS_ACCESS_KEY_ID 'id'",
+                "set -gx AWS_SECRET_ACCESS_KEY 'it\\'s a \\\\secret'",
+                "set -gx DEVENV_AWSENV 'profile'",
+            ]
+        )
+
+    def test_export_nu(self):
+        config = self._makeExportable()
+        config.export("nu")
+        self.assertEqual(
+            config.capture[0].splitlines(),
+            [
+                '$env.AWS_ACCESS_KEY_ID = "id"',
+                '$env.AWS_SECRET_ACCESS_KEY = "it\'s a \\\\secret"',
+                '$env.DEVENV_AWSENV = "profile"',
+            ]
+        )
+
+    def test_export_nu_escapes(self):
+        config = self._makeExportable()
+        config.envdata["AWS_SECRET_ACCESS_KEY"] = 'café\x1b[0m\t"\\u0041'
+        config.export("nu")
+        self.assertEqual(
+            config.capture[0].splitlines()[1],
+            '$env.AWS_SECRET_ACCESS_KEY = "café\\u{001b}[0m\\t\\"\\\\u0041"'
+        )
+
+    def test_export_dotenv(self):
+        config = self._makeExportable()
+        config.export("dotenv")
+        self.assertEqual(
+            config.capture[0].splitlines(),
+            [
+                "AWS_ACCESS_KEY_ID='id'",
+                'AWS_SECRET_ACCESS_KEY="it\'s a \\\\secret"',
+                "DEVENV_AWSENV='profile'",
+            ]
+        )
+
+    def test_export_json(self):
+        config = self._makeExportable()
+        config.export("json")
+        self.assertEqual(
+            json.loads(config.capture[0]),
+            {
+                "AWS_ACCESS_KEY_ID": "id",
+                "AWS_SECRET_ACCESS_KEY": "it's a \\secret",
+                "DEVENV_AWSENV": "profile",
+            }
+        )
+
+    def test_export_direnv(self):
+        config = self._makeExportable()
+        config.export("direnv")
+        lines = config.capture[0].splitlines()
+        stamp = os.path.join(self.state_dir, "profile.changed")
+        status = os.path.join(self.state_dir, "profile.status")
+        self.assertEqual(lines[0], f"watch_file {stamp}")
+        self.assertEqual(lines[1], f"watch_file {status}")
+        self.assertEqual(lines[2], "AWS_ACCESS_KEY_ID=id")
+        self.assertEqual(lines[3], "export AWS_ACCESS_KEY_ID")
+
+    def test_save_touches_stamp(self):
+        config = self._makeOne("profile")
+        stamp = config.stamp_path("profile")
+        os.utime(stamp, (0, 0))
+        config.save("profile", config.keyring.envs["profile"])
+        self.assertTrue(os.path.getmtime(stamp) > 0)
+
+    def test_touch_stamp_unwritable(self):
+        config = self._makeOne("profile")
+        with open(os.path.join(self.state_dir, "file"), "w"):
+            pass
+        config.state_dir = os.path.join(self.state_dir, "file")
+        config.touch_stamp("profile")
+        self.assertFalse(os.path.exists(config.stamp_path("profile")))
+
+    def test_edit_buffer_in_tempdir_mode_0600(self):
+        config = self._makeOne("profile")
+        config.edit_tempdir = lambda: self.state_dir
+        seen = []
+        def call(cmd):
+            fn = cmd[-1]
+            seen.append((os.path.dirname(fn), os.stat(fn).st_mode & 0o777))
+        config.call = call
+        config.errout = lambda msg: None
+        config.edit()
+        self.assertEqual(seen, [(self.state_dir, 0o600)])
+        self.assertEqual(
+            [ f for f in os.listdir(self.state_dir) if f.endswith(".json") ],
+            []
+        )
+
+    def test_edit_tempdir_runtime_dir(self):
+        config = self._makeOne("profile")
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.state_dir}):
+            self.assertEqual(config.edit_tempdir(), self.state_dir)
+
+    def test_edit_tempdir_fallback(self):
+        config = self._makeOne("profile")
+        with mock.patch.dict(os.environ), \
+             mock.patch("os.path.isdir", return_value=False) as isdir:
+            os.environ.pop("XDG_RUNTIME_DIR", None)
+            self.assertEqual(config.edit_tempdir(), None)
+        isdir.assert_called_once_with("/dev/shm")
+
+    def test_set_keys_malformed(self):
+        config = self._makeOne("profile")
+        errors = []
+        config.errout = errors.append
+        self.assertEqual(config.set_keys(["AWS_DEFAULT_REGION"]), 1)
+        self.assertEqual(
+            errors, ["Expected KEY=VALUE, got AWS_DEFAULT_REGION"]
+        )
+
+    def test_set_keys_no_such_env(self):
+        config = self._makeOne("profile")
+        errors = []
+        config.errout = errors.append
+        self.assertEqual(config.set_keys(["A=1"], ["nope"]), 1)
+        self.assertEqual(errors, ["No such env nope"])
+
+    def test_set_keys_unknown_env_writes_nothing(self):
+        config = self._makeOne("profile")
+        meta = json.loads(config.keyring.meta)
+        meta["envs"].append("a")
+        config.keyring.meta = json.dumps(meta)
+        config.keyring.envs["a"] = '{"AWS_ACCESS_KEY_ID": "old"}'
+        # not listed in __meta__
+        config.keyring.envs["stale"] = '{"AWS_ACCESS_KEY_ID": "old"}'
+        errors = []
+        config.errout = errors.append
+        self.assertEqual(
+            config.set_keys(["AWS_ACCESS_KEY_ID=new"], ["a", "stale"]), 1
+        )
+        self.assertEqual(errors, ["No such env stale"])
+        self.assertEqual(
+            config.keyring.envs["a"], '{"AWS_ACCESS_KEY_ID": "old"}'
+        )
+
+    def test_set_keys_unchanged(self):
+        config = self._makeOne("profile")
+        config.keyring.envs["profile-derived"] = '{"a": "5"}'
+        calls = config.keyring_calls
+        self.assertEqual(config.set_keys(["AWS_DEFAULT_OUTPUT=json"]), None)
+        self.assertEqual(config.keyring_calls, calls)
+
+    def test_set_keys_current_keeps_session(self):
+        config = self._makeOne("profile")
+        config.derived = {"a": "5"}
+        config.keyring.envs["profile-derived"] = '{"a": "5"}'
+        errors = []
+        config.errout = errors.append
+        config.set_keys(["AWS_DEFAULT_REGION=us-west-2", "EXTRA=a=b"])
+        saved = json.loads(config.keyring.envs["profile"])
+        self.assertEqual(saved["AWS_DEFAULT_REGION"], "us-west-2")
+        self.assertEqual(saved["EXTRA"], "a=b")
+        self.assertEqual(config.envdata, saved)
+        self.assertEqual(config.keyring.envs["profile-derived"], '{"a": "5"}')
+        self.assertEqual(config.derived, {"a": "5"})
+        self.assertTrue(errors[0].startswith("To activate"))
+
+    def test_set_keys_other_envs_resets_session(self):
+        config = self._makeOne("profile")
+        meta = json.loads(config.keyring.meta)
+        meta["envs"].extend(["a", "b"])
+        config.keyring.meta = json.dumps(meta)
+        for env in ("a", "b"):
+            config.keyring.envs[env] = '{"AWS_ACCESS_KEY_ID": "old"}'
+            config.keyring.envs[f"{env}-derived"] = '{"x": "1"}'
+        errors = []
+        config.errout = errors.append
+        config.set_keys(["AWS_ACCESS_KEY_ID=new"], ["a", "b"])
+        for env in ("a", "b"):
+            self.assertEqual(
+                json.loads(config.keyring.envs[env]),
+                {"AWS_ACCESS_KEY_ID": "new"}
+            )
+            self.assertEqual(config.keyring.envs[f"{env}-derived"], '{}')
+        self.assertEqual(errors, [])
+
+    def test_set_keys_current_resets_session(self):
+        config = self._makeOne("profile")
+        config.derived = {"a": "5"}
+        config.errout = lambda msg: None
+        config.set_keys(["AWS_SECRET_ACCESS_KEY=rotated"])
+        self.assertEqual(config.derived, {})
+        self.assertEqual(config.keyring.envs["profile-derived"], '{}')
+
+    def test_locked_unwritable_state_dir(self):
+        config = self._makeOne("profile")
+        with open(os.path.join(self.state_dir, "file"), "w"):
+            pass
+        config.state_dir = os.path.join(self.state_dir, "file")
+        with config.locked("meta"):
+            pass
+
+    def test_locked_creates_lockfile(self):
+        config = self._makeOne("profile")
+        with config.locked("meta"):
+            self.assertTrue(
+                os.path.exists(os.path.join(self.state_dir, "meta.lock"))
+            )
+
+    def test_auth_adopts_session_from_other_process(self):
+        config = self._makeOne("profile")
+        config.envdata["DEVENV_AWSENV_MFA_DEVICE"] = "device"
+        config.derived["AWS_SESSION_EXPIRES"] = '2022-01-01T08:57:37+00:00'
+        # another awsenv process authenticated after we loaded derived
+        fresh = {"AWS_SESSION_EXPIRES": '2037-01-01T08:57:37+00:00'}
+        config.keyring.envs["profile-derived"] = json.dumps(fresh)
+        calls = []
+        config.run = lambda cmd, env: calls.append(cmd)
+        self.assertEqual(config.auth(), 0)
+        self.assertEqual(config.derived, fresh)
+        # STS is not called
+        self.assertEqual(calls, [])
+
+    def _makeMultiEnv(self):
+        config = self._makeOne("profile")
+        meta = json.loads(config.keyring.meta)
+        meta["envs"] = ["profile", "prod-eu", "otp1", "otp2"]
+        config.keyring.meta = json.dumps(meta)
+        config.envdata = {"AWS_ACCESS_KEY_ID": "profileid"}
+        config.keyring.envs["prod-eu"] = json.dumps(
+            {"AWS_ACCESS_KEY_ID": "prodid", "DEVENV_AWSENV_MFA_DEVICE": ""}
+        )
+        config.keyring.envs["prod-eu-derived"] = "{}"
+        for env in ("otp1", "otp2"):
+            config.keyring.envs[env] = json.dumps({
+                "AWS_ACCESS_KEY_ID": "longterm",
+                "AWS_ACCOUNT_ID": "123",
+                "DEVENV_AWSENV_MFA_DEVICE": "device",
+                "DEVENV_AWSENV_MFA_OTP_AUTHSECRET": "E2OVN6XH7LXUR22ZQ64MAEM2NQ22JEKILF3QUV7W7S6JHYL5BZVAFZNDDLSRW3AZ",
+            })
+            config.keyring.envs[f"{env}-derived"] = "{}"
+        config.which = lambda cmd: cmd
+        config.errors = []
+        config.errout = config.errors.append
+        config.capture = []
+        config.out = config.capture.append
+        return config
+
+    def test_export_many_no_such_env(self):
+        config = self._makeMultiEnv()
+        self.assertEqual(config.export_many(["profile", "nope"]), 1)
+        self.assertEqual(config.errors, ["No such env nope"])
+        self.assertEqual(config.capture, [])
+
+    def test_export_many_prefix_collision(self):
+        config = self._makeMultiEnv()
+        meta = json.loads(config.keyring.meta)
+        meta["envs"].append("prod_eu")
+        config.keyring.meta = json.dumps(meta)
+        config.keyring.envs["prod_eu"] = config.keyring.envs["prod-eu"]
+        config.keyring.envs["prod_eu-derived"] = "{}"
+        self.assertEqual(config.export_many(["prod-eu", "prod_eu"]), 1)
+        self.assertEqual(
+            config.errors,
+            ["Envs prod-eu and prod_eu would both export as AWSENV_PROD_EU_*"]
+        )
+        self.assertEqual(config.capture, [])
+        # JSON output is keyed by env name, so there is no collision
+        self.assertEqual(
+            config.export_many(["prod-eu", "prod_eu"], "json"), None
+        )
+        self.assertEqual(
+            sorted(json.loads(config.capture[0])), ["prod-eu", "prod_eu"]
+        )
+
+    def test_export_many_sh(self):
+        config = self._makeMultiEnv()
+        reads = []
+        get_password = config.keyring.get_password
+        def counting_get_password(ourname, key):
+            reads.append(key)
+            return get_password(ourname, key)
+        config.keyring.get_password = counting_get_password
+        self.assertEqual(
+            config.export_many(["profile", "prod-eu", "prod-eu"]), None
+        )
+        self.assertEqual(reads, ["__meta__", "prod-eu", "prod-eu-derived"])
+        lines = config.capture[0].splitlines()
+        self.assertTrue("watch_file" not in config.capture[0])
+        self.assertEqual(
+            lines,
+            [
+                "AWSENV_PROD_EU_AWS_ACCESS_KEY_ID=prodid",
+                "export AWSENV_PROD_EU_AWS_ACCESS_KEY_ID",
+                "AWSENV_PROD_EU_DEVENV_AWSENV=prod-eu",
+                "export AWSENV_PROD_EU_DEVENV_AWSENV",
+                "AWSENV_PROFILE_AWS_ACCESS_KEY_ID=profileid",
+                "export AWSENV_PROFILE_AWS_ACCESS_KEY_ID",
+                "AWSENV_PROFILE_DEVENV_AWSENV=profile",
+                "export AWSENV_PROFILE_DEVENV_AWSENV",
+            ]
+        )
+
+    def test_export_many_prompts_on_stderr(self):
+        import io
+        config = self._makeMultiEnv()
+        config.keyring.envs["otp1"] = json.dumps({
+            "AWS_ACCESS_KEY_ID": "longterm",
+            "AWS_ACCOUNT_ID": "123",
+            "DEVENV_AWSENV_MFA_DEVICE": "device",
+        })
+        config.run = lambda cmd, env: self._stsSuccess()
+        stdin = io.StringIO("123456\n")
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with mock.patch("sys.stdin", stdin), \
+             mock.patch("sys.stdout", stdout), \
+             mock.patch("sys.stderr", stderr):
+            self.assertEqual(config.export_many(["otp1"]), None)
+        self.assertEqual(stderr.getvalue(), "Input AWS MFA code for otp1: ")
+        self.assertEqual(stdout.getvalue(), "")
+        # only the exported variables reach out
+        for line in config.capture[0].splitlines():
+            self.assertTrue(
+                line.startswith(("AWSENV_OTP1_", "export AWSENV_OTP1_")), line
+            )
+
+    def test_inp_eof(self):
+        import io
+        config = self._makeOne("profile")
+        with mock.patch("sys.stdin", io.StringIO()), \
+             mock.patch("sys.stderr", io.StringIO()):
+            self.assertRaises(EOFError, config.inp, "code: ")
+
+    def test_export_many_direnv_watches_all(self):
+        config = self._makeMultiEnv()
+        config.export_many(["profile", "prod-eu"], "direnv")
+        watched = [
+            line for line in config.capture[0].splitlines()
+            if line.startswith("watch_file")
+        ]
+        self.assertEqual(len(watched), 4)
+
+    def test_export_many_json_authenticates_concurrently(self):
+        config = self._makeMultiEnv()
+        import threading
+        barrier = threading.Barrier(2, timeout=5)
+        expires = datetime.now(timezone.utc) + timedelta(hours=12)
+        def run(cmd, env):
+            # both OTP envs must be in get-session-token at the same time
+            barrier.wait()
+            stdout = json.dumps(
+                {"Credentials":
+                 {
+                     "SessionToken": "token",
+                     "SecretAccessKey": "key",
+                     "AccessKeyId": "sessionid",
+                     "Expiration": expires.isoformat(),
+                 }
+                 }
+            )
+            return FakeResult(0, stdout)
+        config.run = run
+        self.assertEqual(
+            config.export_many(["otp1", "otp2", "prod-eu"], "json"), None
+        )
+        exported = json.loads(config.capture[0])
+        self.assertEqual(sorted(exported), ["otp1", "otp2", "prod-eu"])
+        self.assertEqual(exported["otp1"]["AWS_ACCESS_KEY_ID"], "sessionid")
+        self.assertEqual(exported["otp2"]["AWS_SESSION_TOKEN"], "token")
+        self.assertEqual(exported["prod-eu"]["AWS_ACCESS_KEY_ID"], "prodid")
+
+    def test_export_many_auth_fails(self):
+        config = self._makeMultiEnv()
+        config.run = lambda cmd, env: FakeResult(254, stderr="AccessDenied")
+        self.assertEqual(config.export_many(["otp1"]), 1)
+        self.assertEqual(config.capture, [])
+
+    def _readStatus(self, config, env):
+        with open(config.status_path(env)) as f:
+            return f.read()
+
+    def test_session_status(self):
+        config = self._makeOne("profile")
+        config.warn_before = 600
+        self.assertEqual(config.session_status(None), "none")
+        self.assertEqual(config.session_status(-5), "expired")
+        self.assertEqual(config.session_status(0), "expired")
+        self.assertEqual(config.session_status(600), "expiring")
+        self.assertEqual(config.session_status(601), "ok")
+
+    def test_save_derived_writes_status(self):
+        config = self._makeOne("profile")
+        derived = json.dumps(self._expiresIn(seconds=3600))
+        config.save_derived("profile", derived)
+        self.assertEqual(self._readStatus(config, "profile"), "ok\n")
+        config.save_derived("profile", "{}")
+        self.assertEqual(self._readStatus(config, "profile"), "none\n")
+
+    def test_write_status_unchanged(self):
+        config = self._makeOne("profile")
+        config.write_status("profile", "ok")
+        path = config.status_path("profile")
+        os.utime(path, (0, 0))
+        config.write_status("profile", "ok")
+        self.assertEqual(os.stat(path).st_mtime, 0)
+        config.write_status("profile", "expiring")
+        self.assertNotEqual(os.stat(path).st_mtime, 0)
+        self.assertEqual(self._readStatus(config, "profile"), "expiring\n")
+
+    def test_write_status_unwritable(self):
+        config = self._makeOne("profile")
+        with open(os.path.join(self.state_dir, "file"), "w"):
+            pass
+        config.state_dir = os.path.join(self.state_dir, "file")
+        config.write_status("profile", "ok")
+        self.assertFalse(os.path.exists(config.status_path("profile")))
+
+    def test_for_env(self):
+        config = self._makeOne("profile")
+        config.keyring.envs["another"] = '{"AWS_ACCOUNT_ID": "1"}'
+        config.keyring.envs["another-derived"] = '{"AWS_SESSION_TOKEN": "t"}'
+        other = config.for_env("another")
+        self.assertEqual(other.current_env, "another")
+        self.assertEqual(other.envdata, {"AWS_ACCOUNT_ID": "1"})
+        self.assertEqual(other.derived, {"AWS_SESSION_TOKEN": "t"})
+        self.assertEqual(config.current_env, "profile")
+
+    def _makeWatched(self):
+        config = self._makeOne("profile")
+        config.warn_before = 600
+        meta = json.loads(config.keyring.meta)
+        meta["envs"] = ["profile", "soon", "later", "gone"]
+        config.keyring.meta = json.dumps(meta)
+        config.keyring.envs["soon-derived"] = json.dumps(
+            self._expiresIn(seconds=700)
+        )
+        config.keyring.envs["later-derived"] = json.dumps(
+            self._expiresIn(seconds=7200)
+        )
+        config.keyring.envs["gone-derived"] = json.dumps(
+            self._expiresIn(seconds=-10)
+        )
+        return config
+
+    def test_watch_once(self):
+        config = self._makeWatched()
+        wake = config.watch_once()
+        # the next deadline is "soon" entering its warning period
+        self.assertTrue(90 <= wake <= 100)
+        self.assertEqual(self._readStatus(config, "profile"), "none\n")
+        self.assertEqual(self._readStatus(config, "soon"), "ok\n")
+        self.assertEqual(self._readStatus(config, "later"), "ok\n")
+        self.assertEqual(self._readStatus(config, "gone"), "expired\n")
+
+    def test_watch_once_nothing_pending(self):
+        config = self._makeOne("profile")
+        self.assertEqual(config.watch_once(), 900)
+
+    def test_watch_once_refresh(self):
+        config = self._makeWatched()
+        config.keyring.envs["gone"] = json.dumps({
+            "AWS_ACCOUNT_ID": "123",
+            "DEVENV_AWSENV_MFA_DEVICE": "device",
+            "DEVENV_AWSENV_MFA_OTP_AUTHSECRET": "E2OVN6XH7LXUR22ZQ64MAEM2NQ22JEKILF3QUV7W7S6JHYL5BZVAFZNDDLSRW3AZ",
+        })
+        config.keyring.envs["soon"] = json.dumps({
+            "DEVENV_AWSENV_MFA_DEVICE": "device",
+        })
+        config.keyring.envs["later"] = config.keyring.envs["gone"]
+        config.keyring.envs["later-derived"] = json.dumps(
+            self._expiresIn(seconds=850)
+        )
+        config.warn_before = 800
+        config.refresh_offset = lambda: 100
+        config.which = lambda cmd: cmd
+        config.errout = lambda msg: None
+        expires = datetime.now(timezone.utc) + timedelta(hours=12)
+        calls = []
+        def run(cmd, env):
+            calls.append(cmd)
+            stdout = json.dumps(
+                {"Credentials":
+                 {
+                     "SessionToken": "token",
+                     "SecretAccessKey": "key",
+                     "AccessKeyId": "id",
+                     "Expiration": expires.isoformat(),
+                 }
+                 }
+            )
+            return FakeResult(0, stdout)
+        config.run = run
+        config.watch_once(refresh=True)
+        # "later" is within its jittered head start of the warning period;
+        # "soon" has no OTP secret so it can't be refreshed unattended
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self._readStatus(config, "gone"), "ok\n")
+        self.assertEqual(self._readStatus(config, "later"), "ok\n")
+        self.assertEqual(self._readStatus(config, "soon"), "expiring\n")
+        self.assertEqual(config.refresh_jitter, {"profile": 100, "soon": 100})
+
+    def test_watch_once_refresh_not_due(self):
+        config = self._makeWatched()
+        config.keyring.envs["later"] = json.dumps({
+            "DEVENV_AWSENV_MFA_DEVICE": "device",
+            "DEVENV_AWSENV_MFA_OTP_AUTHSECRET": "secret",
+        })
+        config.keyring.envs["soon-derived"] = json.dumps(
+            self._expiresIn(seconds=1500)
+        )
+        config.keyring.envs["gone-derived"] = "{}"
+        config.refresh_offset = lambda: 100
+        config.run = None # must not be called
+        wake = config.watch_once(refresh=True)
+        # wakes for "soon" at its jittered refresh point, 700s before expiry
+        self.assertTrue(790 <= wake <= 800)
+        self.assertEqual(config.refresh_jitter["later"], 100)
+        config.refresh_offset = lambda: 200
+        config.watch_once(refresh=True)
+        # the head start stays put until the env has been refreshed
+        self.assertEqual(config.refresh_jitter["later"], 100)
+
+    def test_watch(self):
+        config = self._makeOne("profile")
+        class Stop(Exception):
+            pass
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                raise Stop
+        config.sleep = sleep
+        self.assertRaises(Stop, config.watch)
+        self.assertEqual(sleeps, [900, 900])
+
+    def _makeWhoami(self):
+        config = self._makeOne("profile")
+        config.envdata.update({
+            "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+            "AWS_SECRET_ACCESS_KEY": "secret",
+            "AWS_DEFAULT_REGION": "eu-west-1",
+        })
+        config.capture = []
+        config.out = config.capture.append
+        config.errors = []
+        config.errout = config.errors.append
+        config.posts = []
+        def post(url, headers, body):
+            config.posts.append((url, headers, body))
+            return (
+                '<GetCallerIdentityResponse '
+                'xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+                '<GetCallerIdentityResult>'
+                '<Arn>arn:aws:iam::123456789012:user/chris</Arn>'
+                '<UserId>AIDAEXAMPLE</UserId>'
+                '<Account>123456789012</Account>'
+                '</GetCallerIdentityResult>'
+                '</GetCallerIdentityResponse>'
+            ).encode("utf-8")
+        config.post = post
+        return config
+
+    def test_whoami_no_credentials(self):
+        config = self._makeWhoami()
+        config.envdata["AWS_ACCESS_KEY_ID"] = ""
+        self.assertEqual(config.whoami(), 1)
+        self.assertEqual(
+            config.errors, ["No AWS credentials set for profile"]
+        )
+
+    def test_whoami_queries_then_caches(self):
+        config = self._makeWhoami()
+        identity = {
+            "UserId": "AIDAEXAMPLE",
+            "Account": "123456789012",
+            "Arn": "arn:aws:iam::123456789012:user/chris",
+        }
+        self.assertEqual(config.whoami(), 0)
+        self.assertEqual(json.loads(config.capture[0]), identity)
+        url, headers, body = config.posts[0]
+        self.assertEqual(url, "https://sts.eu-west-1.amazonaws.com/")
+        self.assertEqual(body, "Action=GetCallerIdentity&Version=2011-06-15")
+        self.assertEqual(
+            os.stat(config.whoami_cache_path()).st_mode & 0o777, 0o600
+        )
+        self.assertEqual(config.whoami(), 0)
+        self.assertEqual(len(config.posts), 1)
+        self.assertEqual(json.loads(config.capture[1]), identity)
+        self.assertEqual(config.whoami(refresh=True), 0)
+        self.assertEqual(len(config.posts), 2)
+
+    def test_whoami_cache_keyed_by_session(self):
+        config = self._makeWhoami()
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        config.derived = {
+            "AWS_ACCESS_KEY_ID": "ASIAEXAMPLE",
+            "AWS_SESSION_TOKEN": "token1",
+            "AWS_SESSION_EXPIRES": expires.isoformat(),
+        }
+        config.whoami()
+        cache = config.load_whoami_cache()
+        self.assertEqual(
+            [ entry["expires"] for entry in cache.values() ],
+            [ expires.isoformat() ]
+        )
+        self.assertEqual(
+            config.posts[0][1]["x-amz-security-token"], "token1"
+        )
+        # "awsenv auth" created a new session
+        config.derived["AWS_SESSION_TOKEN"] = "token2"
+        config.whoami()
+        self.assertEqual(len(config.posts), 2)
+        self.assertEqual(len(config.load_whoami_cache()), 2)
+
+    def test_whoami_drops_expired_entries(self):
+        config = self._makeWhoami()
+        config.save_whoami_cache({
+            "old": {"identity": {}, "expires": "2022-01-01T00:00:00+00:00"},
+            "junk": {},
+        })
+        config.whoami()
+        self.assertEqual(len(config.load_whoami_cache()), 1)
+
+    def test_whoami_sts_error(self):
+        config = self._makeWhoami()
+        import io
+        import urllib.error
+        def post(url, headers, body):
+            raise urllib.error.HTTPError(
+                url, 403, "Forbidden", {}, io.BytesIO(
+                    b'<ErrorResponse '
+                    b'xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+                    b'<Error><Type>Sender</Type><Code>ExpiredToken</Code>'
+                    b'<Message>The security token included in the request '
+                    b'is expired</Message></Error></ErrorResponse>'
+                )
+            )
+        config.post = post
+        self.assertEqual(config.whoami(), 1)
+        self.assertEqual(
+            config.errors,
+            [
+                "GetCallerIdentity failed: ExpiredToken: The security token "
+                "included in the request is expired"
+            ]
+        )
+        self.assertEqual(config.load_whoami_cache(), {})
+
+    def test_whoami_http_error_not_xml(self):
+        config = self._makeWhoami()
+        import io
+        import urllib.error
+        def post(url, headers, body):
+            raise urllib.error.HTTPError(
+                url, 502, "Bad Gateway", {}, io.BytesIO(b"<html>")
+            )
+        config.post = post
+        self.assertEqual(config.whoami(), 1)
+        self.assertEqual(config.errors, ["GetCallerIdentity failed: HTTP 502"])
+
+    def test_whoami_network_error(self):
+        config = self._makeWhoami()
+        import urllib.error
+        def post(url, headers, body):
+            raise urllib.error.URLError("Name or service not known")
+        config.post = post
+        self.assertEqual(config.whoami(), 1)
+        self.assertEqual(
+            config.errors,
+            ["GetCallerIdentity failed: Name or service not known"]
+        )
+
+    def test_load_whoami_cache_malformed(self):
+        config = self._makeWhoami()
+        with open(config.whoami_cache_path(), "w") as f:
+            f.write("{malformed")
+        self.assertEqual(config.load_whoami_cache(), {})
+
+    def test_load_whoami_cache_not_an_object(self):
+        config = self._makeWhoami()
+        with open(config.whoami_cache_path(), "w") as f:
+            f.write("[]")
+        self.assertEqual(config.load_whoami_cache(), {})
+        self.assertEqual(config.whoami(), 0)
+        self.assertEqual(len(config.posts), 1)
+
+    def test_load_whoami_cache_malformed_entries(self):
+        config = self._makeWhoami()
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        good = {"identity": {"Account": "1"}, "expires": expires.isoformat()}
+        config.save_whoami_cache({
+            "list": [],
+            "string": "x",
+            "identity": {"identity": [], "expires": expires.isoformat()},
+            "expires": {"identity": {}, "expires": ["2037"]},
+            "good": good,
+        })
+        self.assertEqual(config.load_whoami_cache(), {"good": good})
+
+    def test_whoami_unexpected_response(self):
+        config = self._makeWhoami()
+        for response in (
+                b"<html>",
+                b'<GetCallerIdentityResponse '
+                b'xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+                b'</GetCallerIdentityResponse>',
+        ):
+            config.post = lambda url, headers, body: response
+            self.assertEqual(config.whoami(), 1)
+        self.assertEqual(
+            config.errors,
+            ["GetCallerIdentity failed: unexpected response"] * 2
+        )
+        self.assertEqual(config.load_whoami_cache(), {})
+
+    def test_save_whoami_cache_unwritable(self):
+        config = self._makeWhoami()
+        with open(os.path.join(self.state_dir, "file"), "w"):
+            pass
+        config.state_dir = os.path.join(self.state_dir, "file")
+        config.save_whoami_cache({})
+        self.assertEqual(config.load_whoami_cache(), {})
+
+class TestCallerIdentityRequest(unittest.TestCase):
+    def _callFUT(self, creds):
+        from awsenv import caller_identity_request
+        now = datetime(2026, 10, 18, 12, 0, 0, tzinfo=timezone.utc)
+        return caller_identity_request(
+            creds, "eu-west-1", "https://sts.eu-west-1.amazonaws.com/", now
+        )
+
+    def test_sigv4(self):
+        creds = {
+            "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+            "AWS_SECRET_ACCESS_KEY": "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+        }
+        url, headers, body = self._callFUT(creds)
+        self.assertEqual(url, "https://sts.eu-west-1.amazonaws.com/")
+        self.assertEqual(headers["host"], "sts.eu-west-1.amazonaws.com")
+        self.assertEqual(headers["x-amz-date"], "20261018T120000Z")
+        self.assertEqual(
+            headers["authorization"],
+            "AWS4-HMAC-SHA256 "
+            "Credential=AKIDEXAMPLE/20261018/eu-west-1/sts/aws4_request, "
+            "SignedHeaders=content-type;host;x-amz-date, "
+            "Signature="
+            "4874a7023c3f61c256e2cd92c0f1ad4cb6b3ce8e396f738ba1da14aa20ff5d81"
+        )
+
+class TestAcquireWatchLock(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.state_dir = os.path.join(self.tempdir.name, "state")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _callFUT(self):
+        from awsenv import acquire_watch_lock
+        return acquire_watch_lock(self.state_dir)
+
+    def test_it(self):
+        lock = self._callFUT()
+        try:
+            self.assertIsNotNone(lock)
+            self.assertIsNone(self._callFUT())
+        finally:
+            lock.close()
+        lock = self._callFUT()
+        self.assertIsNotNone(lock)
+        lock.close()
+
+class TestStateDir(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def _callFUT(self):
+        from awsenv import get_state_dir
+        return get_state_dir()
+
+    def test_override(self):
+        os.environ["DEVENV_AWSENV_STATE_DIR"] = "/state"
+        self.assertEqual(self._callFUT(), "/state")
+
+    def test_xdg_state_home(self):
+        os.environ.pop("DEVENV_AWSENV_STATE_DIR", None)
+        os.environ["XDG_STATE_HOME"] = "/xdg"
+        self.assertEqual(self._callFUT(), "/xdg/devenv-awsenv")
+
+    def test_default(self):
+        os.environ.pop("DEVENV_AWSENV_STATE_DIR", None)
+        os.environ.pop("XDG_STATE_HOME", None)
+        os.environ["HOME"] = "/home/user"
+        self.assertEqual(
+            self._callFUT(), "/home/user/.local/state/devenv-awsenv"
+        )
+
+class TestPercentile(unittest.TestCase):
+    def _callFUT(self, values, pct):
+        from awsenv import percentile
+        return percentile(values, pct)
+
+    def test_it(self):
+        values = list(range(1, 101))
+        self.assertEqual(self._callFUT(values, 50), 50)
+        self.assertEqual(self._callFUT(values, 95), 95)
+        self.assertEqual(self._callFUT([3], 95), 3)
+        self.assertEqual(self._callFUT([3, 1], 0), 1)
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.state_dir = os.path.join(self.tempdir.name, "state")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _makeOne(self):
+        from awsenv import EventLog
+        return EventLog(self.state_dir)
+
+    def test_append_and_load(self):
+        log = self._makeOne()
+        log.append({"command": "export"})
+        log.append({"command": "auth"})
+        with open(log.path, "a") as f:
+            f.write("{malformed\n")
+        self.assertEqual(
+            log.load(), [{"command": "export"}, {"command": "auth"}]
+        )
+
+    def test_append_unwritable(self):
+        with open(os.path.join(self.tempdir.name, "file"), "w"):
+            pass
+        from awsenv import EventLog
+        log = EventLog(os.path.join(self.tempdir.name, "file"))
+        log.append({"command": "export"})
+        self.assertEqual(log.load(), [])
+
+    def test_rotate(self):
+        import awsenv
+        log = self._makeOne()
+        old_max = awsenv.EVENT_LOG_MAX_BYTES
+        awsenv.EVENT_LOG_MAX_BYTES = 1
+        try:
+            for n in range(5):
+                log.append({"n": n})
+        finally:
+            awsenv.EVENT_LOG_MAX_BYTES = old_max
+        self.assertFalse(os.path.exists(log.rotated(4)))
+        self.assertEqual(log.load(), [{"n": 1}, {"n": 2}, {"n": 3}, {"n": 4}])
+
+    def test_stats_empty(self):
+        log = self._makeOne()
+        capture = []
+        self.assertEqual(log.stats(capture.append), 1)
+        self.assertTrue(capture[0].startswith("No events recorded"))
+
+    def test_stats(self):
+        log = self._makeOne()
+        for n in range(10):
+            log.append({
+                "command": "export",
+                "env": "dev",
+                "host": "laptop",
+                "backend": "SecretService",
+                "duration": 0.1 * (n + 1),
+                "keyring_calls": 4,
+                "subprocess_time": 0.0,
+                "outcome": "ok",
+            })
+        log.append({
+            "command": "auth",
+            "env": "dev",
+            "host": "laptop",
+            "backend": "SecretService",
+            "duration": 3.0,
+            "keyring_calls": 6,
+            "subprocess_time": 2.5,
+            "outcome": "ok",
+            "authenticated": True,
+        })
+        log.append({
+            "command": "auth",
+            "env": "prod",
+            "host": "laptop",
+            "duration": 0.2,
+            "outcome": "exception",
+        })
+        capture = []
+        log.stats(capture.append)
+        lines = "\n".join(capture)
+        self.assertTrue(
+            "auth                                  2   0.200s   3.000s   50.0%"
+            in lines
+        )
+        self.assertTrue(
+            "export                               10   0.500s   1.000s    0.0%"
+            in lines
+        )
+        self.assertTrue("laptop (SecretService)" in lines)
+        self.assertTrue("keyring calls per command (p50/p95): 4/6" in lines)
+        self.assertTrue(
+            "  dev                                 1" in lines
+        )
+
+    def test_stats_no_sessions(self):
+        log = self._makeOne()
+        log.append({"command": "export", "duration": 0.1, "outcome": "ok"})
+        capture = []
+        log.stats(capture.append)
+        self.assertEqual(capture[-1], "  (none)")
+
 if __name__ == '__main__':
     unittest.main()